@@ -0,0 +1,359 @@
+"""Microbenchmarks of the routing and filtering hot paths.
+
+Runs `get_destination`, `predicate_text`, `SourceRoute.match` (keywords and
+`when` conditions), `ChatConfig` parsing and `reload_config` against generated
+rule sets and mixed CJK/Latin messages, and reports ops/sec and the memory
+allocated per call.
+
+    python benchmarks/bench_routing.py                            # run and print the results
+    python benchmarks/bench_routing.py --save before.json         # store them as a baseline
+    python benchmarks/bench_routing.py --baseline before.json     # compare with a baseline
+
+The bot is imported in a temporary directory with dummy credentials, so this
+needs the python dependencies but no Telegram account or chat_list.json.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RULE_COUNTS = (10, 1000, 10000)
+KEYWORD_COUNTS = (1, 10, 100, 1000)
+SEED = 20240501
+
+LATIN_WORDS = (
+    "btc eth sol usdt airdrop presale listing binance okx long short pump dump "
+    "breaking news update alert signal entry target stop loss profit whale "
+    "market price chart volume launch token nft defi staking bridge wallet"
+).split()
+CJK_WORDS = (
+    "比特币 以太坊 空投 预售 上线 合约 现货 做多 做空 暴涨 暴跌 突发 快讯 "
+    "公告 信号 入场 止损 止盈 巨鲸 行情 价格 成交量 钱包 质押 跨链 广告 "
+    "推广 福利 抽奖 诈骗 招聘 兼职 官方 社区 交易所 币安 欧易"
+).split()
+PUNCTUATION = ("，", "。", "！", "？", "、", ",", ".", "!", ":", " - ", "…")
+
+
+def _prepare_environment(workdir: str):
+    """Make `import forwarder` work without a real setup"""
+    os.chdir(workdir)
+    with open("chat_list.json", "w") as f:
+        f.write("[]")
+    os.environ.update(
+        API_ID="1",
+        API_HASH="benchmark",
+        SESSION_NAME="benchmark",
+        DATA_DIR=os.path.join(workdir, "data"),
+        CONFIG_WATCH_INTERVAL="0",
+    )
+    sys.path.insert(0, ROOT)
+
+
+def make_keywords(rng: random.Random, count: int) -> List[str]:
+    words = set()
+    while len(words) < count:
+        if rng.random() < 0.5:
+            word = rng.choice(LATIN_WORDS)
+            if rng.random() < 0.5:
+                word += str(rng.randrange(1000))
+        else:
+            word = rng.choice(CJK_WORDS)
+            if rng.random() < 0.5:
+                word += rng.choice(CJK_WORDS)
+        words.add(word)
+    return sorted(words)
+
+
+def make_text(rng: random.Random, words: int) -> str:
+    """A channel post mixing Chinese, English, numbers, tags and links"""
+    parts = []
+    for _ in range(words):
+        roll = rng.random()
+        if roll < 0.45:
+            parts.append(rng.choice(CJK_WORDS))
+        elif roll < 0.8:
+            word = rng.choice(LATIN_WORDS)
+            parts.append(word.upper() if rng.random() < 0.2 else word)
+        elif roll < 0.9:
+            parts.append(f"{rng.randrange(1, 100000)}{rng.choice(('', '%', 'U', '万'))}")
+        elif roll < 0.95:
+            parts.append(f"#{rng.choice(LATIN_WORDS)}")
+        else:
+            parts.append(f"https://t.me/{rng.choice(LATIN_WORDS)}/{rng.randrange(100000)}")
+        parts.append(rng.choice(PUNCTUATION) if rng.random() < 0.25 else " ")
+    return "".join(parts).strip()
+
+
+def make_texts(rng: random.Random) -> List[str]:
+    # 短消息为主，夹杂长公告
+    sizes = [8] * 6 + [40] * 3 + [300]
+    return [make_text(rng, size) for size in sizes]
+
+
+def make_rules(rng: random.Random, count: int) -> list:
+    """Rules in the chat_list.json format, about two per source"""
+    sources = max(1, count // 2)
+    rules = []
+    for number in range(count):
+        source = -1001000000000 - rng.randrange(sources)
+        rule: Dict[str, object] = {
+            "source": f"{source}#{rng.randrange(1, 50)}" if rng.random() < 0.1 else source,
+            "destination": [
+                -1002000000000 - rng.randrange(count)
+                if rng.random() < 0.8
+                else f"{-1002000000000 - rng.randrange(count)}#{rng.randrange(1, 50)}"
+                for _ in range(rng.randint(1, 3))
+            ],
+        }
+        roll = rng.random()
+        if roll < 0.5:
+            rule["filters"] = make_keywords(rng, rng.randint(3, 20))
+        if 0.3 < roll < 0.7:
+            rule["blacklist"] = make_keywords(rng, rng.randint(1, 10))
+        if rng.random() < 0.2:
+            rule["name"] = f"rule-{number}"
+        rules.append(rule)
+    return rules
+
+
+class Runner:
+    def __init__(self, min_time: float, repeat: int):
+        self.min_time = min_time
+        self.repeat = repeat
+        self.results: Dict[str, Dict[str, float]] = {}
+
+    def bench(self, name: str, func: Callable[[], object], setup: Optional[Callable] = None):
+        """Time `func`, calling `setup` untimed before every call when given"""
+        if setup is None:
+            timing = self._time_loop(func)
+        else:
+            timing = self._time_each(func, setup)
+        allocated = self._allocations(func, setup)
+        self.results[name] = {"ops": timing, "alloc": allocated}
+        print(f"{name:<52} {timing:>14,.0f} ops/s {allocated:>12,.0f} B/op")
+
+    def _time_loop(self, func: Callable) -> float:
+        # 先估算每轮次数，使每轮至少运行 min_time 秒
+        loops = 1
+        while True:
+            elapsed = self._run(func, loops)
+            if elapsed >= self.min_time / 10 or loops >= 10**7:
+                break
+            loops *= 10
+        loops = max(1, int(loops * self.min_time / max(elapsed, 1e-9)))
+        best = min(self._run(func, loops) for _ in range(self.repeat))
+        return loops / best
+
+    @staticmethod
+    def _run(func: Callable, loops: int) -> float:
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            for _ in range(loops):
+                func()
+            return time.perf_counter() - start
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _time_each(self, func: Callable, setup: Callable) -> float:
+        best = float("inf")
+        for _ in range(self.repeat):
+            calls = 0
+            total = 0.0
+            while total < self.min_time:
+                setup()
+                start = time.perf_counter()
+                func()
+                total += time.perf_counter() - start
+                calls += 1
+            best = min(best, total / calls)
+        return 1 / best
+
+    def _allocations(self, func: Callable, setup: Optional[Callable], calls: int = 5) -> float:
+        """Average peak memory allocated during one call"""
+        if setup is not None:
+            setup()
+        func()
+        tracemalloc.start()
+        try:
+            total = 0
+            done = 0
+            started = time.perf_counter()
+            # tracemalloc 很慢，耗时长的只测一次
+            while done < calls and (done == 0 or time.perf_counter() - started < self.min_time):
+                if setup is not None:
+                    setup()
+                current, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                func()
+                _, peak = tracemalloc.get_traced_memory()
+                total += peak - current
+                done += 1
+        finally:
+            tracemalloc.stop()
+        return total / done
+
+
+def run(runner: Runner):
+    from forwarder import CONFIG
+    from forwarder.utils import chat
+    from forwarder.utils.chat import (
+        ChatConfig,
+        SourceRoute,
+        get_config,
+        get_destination,
+        parse_config,
+        reload_config,
+    )
+    from forwarder.utils.message import predicate_text
+
+    rng = random.Random(SEED)
+    texts = make_texts(rng)
+
+    print("# ChatConfig")
+    runner.bench("ChatConfig(int)", lambda: ChatConfig(-1001234567890))
+    runner.bench("ChatConfig(str topic)", lambda: ChatConfig("-1001234567890#42"))
+
+    for count in KEYWORD_COUNTS:
+        keywords = make_keywords(rng, count)
+        print(f"# {count} keywords")
+        # 每次调用处理一批消息，包括命中和未命中
+        runner.bench(
+            f"predicate_text kw={count}",
+            lambda: [predicate_text(keywords, text) for text in texts],
+        )
+        route = SourceRoute(parse_config([{"source": 1, "destination": [2], "filters": keywords}]))
+        runner.bench(
+            f"SourceRoute.match kw={count}", lambda: [route.match(text, ()) for text in texts]
+        )
+
+    # 便宜的条件在关键词扫描前短路，正则在扫描后
+    when = {
+        "all": [
+            {"regex": r"(?i)btc\s*\d+"},
+            {"media": ["photo", "text"]},
+            {"not": {"sender": [1, 2, 3]}},
+        ]
+    }
+    rule = {"source": 1, "destination": [2], "filters": keywords, "when": when}
+    route = SourceRoute(parse_config([rule]))
+    print("# when condition")
+    for name, sender in (("passes", 4), ("rejected early", 1)):
+        author = SimpleNamespace(id=sender)
+        messages = [SimpleNamespace(media=None, from_user=None, sender_chat=author)]
+        runner.bench(
+            f"SourceRoute.match when ({name})",
+            lambda: [route.match(text, messages) for text in texts],
+        )
+
+    for count in RULE_COUNTS:
+        raw = make_rules(rng, count)
+        print(f"# {count} rules")
+
+        def cold():
+            chat.apply_config([])
+            CONFIG[:] = raw
+
+        runner.bench(f"reload_config rules={count} (cold)", reload_config, setup=cold)
+        runner.bench(f"reload_config rules={count} (unchanged)", reload_config)
+
+        changed = dict(raw[0], destination=[-1003000000000])
+
+        def change_one():
+            CONFIG[0] = changed if CONFIG[0] is not changed else raw[0]
+
+        runner.bench(f"reload_config rules={count} (1 changed)", reload_config, setup=change_one)
+        CONFIG[:] = raw
+        reload_config()
+
+        keys = [(rule.source.get_id(), rule.source.get_topic()) for rule in get_config()]
+        hits = [rng.choice(keys) for _ in range(100)]
+        misses = [(-1009000000000 - i, None) for i in range(100)]
+        lookups = hits + misses
+        runner.bench(
+            f"get_destination rules={count} (x200)",
+            lambda: [get_destination(source, topic) for source, topic in lookups],
+        )
+
+        routes = [chat.get_route(source, topic) for source, topic in hits[:10]]
+        runner.bench(
+            f"route.match rules={count} (10 sources)",
+            lambda: [route.match(text, ()) for route in routes for text in texts],
+        )
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: dict, threshold: float) -> bool:
+    """Print the change against the baseline, return False on a regression"""
+    ok = True
+    print(f"\n{'benchmark':<52} {'ops/s':>9} {'alloc':>9}")
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if before is None:
+            print(f"{name:<52} {'new':>9}")
+            continue
+        speed = result["ops"] / before["ops"] - 1
+        alloc = (result["alloc"] - before["alloc"]) / max(before["alloc"], 1)
+        flag = ""
+        if speed < -threshold:
+            flag = "  << slower"
+            ok = False
+        elif alloc > threshold and result["alloc"] - before["alloc"] > 1024:
+            flag = "  << allocates more"
+            ok = False
+        print(f"{name:<52} {speed:>+9.1%} {alloc:>+9.1%}{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--save", metavar="FILE", help="store the results as a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the results with a baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="fail when a benchmark is this much slower than the baseline (default 0.2)",
+    )
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per measurement")
+    parser.add_argument("--repeat", type=int, default=3, help="measurements per benchmark")
+    args = parser.parse_args()
+    if args.baseline is not None and not os.path.isfile(args.baseline):
+        parser.error(f"no baseline at {args.baseline}, run with --save to create one")
+
+    runner = Runner(args.min_time, args.repeat)
+    with tempfile.TemporaryDirectory(prefix="forwarder-bench-") as workdir:
+        cwd = os.getcwd()
+        _prepare_environment(workdir)
+        try:
+            run(runner)
+        finally:
+            os.chdir(cwd)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {"python": sys.version.split()[0], "results": runner.results}, f, indent=2
+            )
+        print(f"\nBaseline saved to {os.path.abspath(args.save)}")
+
+    if args.baseline is None:
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if not compare(runner.results, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,25 @@
 import logging
 import json
-from os import getenv, path
+from os import getenv, makedirs, path
 
 from dotenv import load_dotenv
 from pyrogram import Client
 
+from forwarder.logs import setup_logging
+
 load_dotenv(".env")
 
+# 多进程模式
+WORKERS = max(1, int(getenv("WORKERS", "1")))  # 工作进程数，大于 1 时按源把规则分给多个进程
+SHARD = int(getenv("FORWARDER_SHARD", "-1"))  # 工作进程的编号，由主进程设置，-1 表示不是工作进程
+SHARDED = WORKERS > 1 and SHARD >= 0
 
-logging.basicConfig(
-    format="[ %(asctime)s: %(levelname)-8s ] %(name)-20s - %(message)s",
-    level=logging.INFO,
-)
+# 日志
+LOG_LEVEL = getenv("LOG_LEVEL", "INFO").upper()  # DEBUG / INFO / WARNING / ERROR
+LOG_FORMAT = getenv("LOG_FORMAT", "text").lower()  # text 或 json (每行一个 JSON 对象)
+LOG_QUEUE = getenv("LOG_QUEUE", "True") in {"true", "True", "1"}  # 在后台线程格式化和输出日志，不阻塞事件循环
+
+setup_logging(LOG_LEVEL, LOG_FORMAT == "json", LOG_QUEUE, SHARD if SHARDED else None)
 
 LOGGER = logging.getLogger(__name__)
 
@@ -22,6 +30,18 @@ pyrogram_logger.setLevel(logging.WARNING)
 asyncio_logger = logging.getLogger('asyncio')
 asyncio_logger.setLevel(logging.CRITICAL)
 
+# 运行数据目录 (发送队列等)
+BASE_DATA_DIR = getenv("DATA_DIR", "data")
+
+
+def shard_data_dir(shard: int) -> str:
+    """Data directory of a worker process, shard 0 uses DATA_DIR itself"""
+    return path.join(BASE_DATA_DIR, f"shard-{shard}") if shard > 0 else BASE_DATA_DIR
+
+
+DATA_DIR = shard_data_dir(SHARD) if SHARDED else BASE_DATA_DIR
+makedirs(DATA_DIR, exist_ok=True)
+
 # load json file
 config_name = "chat_list.json"
 if not path.isfile(config_name):
@@ -29,6 +49,8 @@ if not path.isfile(config_name):
     exit(1)
 with open(config_name, "r") as data:
     CONFIG = json.load(data)
+CONFIG_WATCH_INTERVAL = float(getenv("CONFIG_WATCH_INTERVAL", "5"))  # 检查配置文件修改的间隔秒数，0 为不检查
+CONFIG_SAVE_DELAY = float(getenv("CONFIG_SAVE_DELAY", "1"))  # 命令修改配置后延迟多少秒写入，期间的修改合并写入
 
 
 API_ID = getenv("API_ID")
@@ -42,6 +64,70 @@ if not API_ID or not API_HASH:
 OWNER_ID = int(getenv("OWNER_ID", "0"))
 REMOVE_TAG = getenv("REMOVE_TAG", "False") in {"true", "True", "1"}
 
+# 源禁止转发时重新上传
+REUPLOAD_PROTECTED = getenv("REUPLOAD_PROTECTED", "True") in {"true", "True", "1"}  # 源禁止转发和复制时下载后重新发送
+TRANSFER_CONCURRENCY = int(getenv("TRANSFER_CONCURRENCY", "2"))  # 同时下载/上传的文件数
+TRANSFER_MEMORY_LIMIT = int(getenv("TRANSFER_MEMORY_LIMIT", "16")) * 1024 * 1024  # 单个文件在内存中缓冲的 MB 数，超出部分写入临时文件
+TRANSFER_CACHE_SIZE = int(getenv("TRANSFER_CACHE_SIZE", "1000"))  # 记住多少个已上传文件的 file_id
+
+# 发送配置
+MAX_CONCURRENT_SENDS = int(getenv("MAX_CONCURRENT_SENDS", "8"))  # 同时发送的目标数上限
+GLOBAL_SEND_RATE = float(getenv("GLOBAL_SEND_RATE", "20"))  # 每秒总发送数，0 为不限
+CHAT_SEND_RATE = float(getenv("CHAT_SEND_RATE", "1"))  # 每个目标每秒发送数，0 为不限
+MAX_SEND_ATTEMPTS = int(getenv("MAX_SEND_ATTEMPTS", "5"))  # 失败多少次后放弃该消息
+ALBUM_WAIT = float(getenv("ALBUM_WAIT", "1"))  # 等待相册其余部分的秒数
+BATCH_WINDOW = int(getenv("BATCH_WINDOW", "0"))  # 合并连续消息的等待毫秒数，0 为不合并
+BATCH_SIZE = int(getenv("BATCH_SIZE", "50"))  # 每次合并转发的最大消息数
+MAX_DESTINATION_BACKLOG = int(getenv("MAX_DESTINATION_BACKLOG", "0"))  # 每个目标最多积压多少条待发送消息，0 为不限
+DESTINATION_OVERFLOW = getenv("DESTINATION_OVERFLOW", "drop_oldest")  # 积压超出时: drop_oldest / drop_newest / media_only / sample:N
+SKIP_NOTICE_INTERVAL = int(getenv("SKIP_NOTICE_INTERVAL", "60"))  # 每隔多少秒向目标发送一次跳过了多少条消息的提示，0 为不发送
+
+# 多账号发送
+SENDER_SESSIONS = [name.strip() for name in getenv("SENDER_SESSIONS", "").split(",") if name.strip()]  # 额外发送账号的 session 名
+SENDER_USE_MAIN = getenv("SENDER_USE_MAIN", "True") in {"true", "True", "1"}  # 监听账号是否也参与发送
+PEER_WARMUP_CONCURRENCY = int(getenv("PEER_WARMUP_CONCURRENCY", "8"))  # 启动时同时解析的聊天数，0 为不预先解析
+
+# 补发错过的消息
+CATCHUP_LIMIT = int(getenv("CATCHUP_LIMIT", "1000"))  # 启动时每个源最多补发多少条停机期间的消息，0 为不补发
+CATCHUP_CONCURRENCY = int(getenv("CATCHUP_CONCURRENCY", "4"))  # 同时读取历史消息的源数
+CATCHUP_INTERVAL = int(getenv("CATCHUP_INTERVAL", "0"))  # 运行中每隔多少秒检查一次是否漏掉消息，0 为只在启动时
+
+# 去重配置
+DEDUP_TTL = int(getenv("DEDUP_TTL", "0"))  # 同一内容在多少秒内不重复发往同一目标，0 为不去重
+DEDUP_SIZE = int(getenv("DEDUP_SIZE", "100000"))  # 最多记住多少条
+DEDUP_SNAPSHOT = getenv("DEDUP_SNAPSHOT", "True") in {"true", "True", "1"}  # 重启后保留
+
+# 同步编辑和删除
+MESSAGE_MAP_DAYS = float(getenv("MESSAGE_MAP_DAYS", "7"))  # 记住转发出的消息多少天，用于同步编辑、删除和回复，0 为不记录
+SYNC_EDITS = getenv("SYNC_EDITS", "True") in {"true", "True", "1"}  # 源消息编辑后同步修改复制出的消息
+SYNC_DELETES = getenv("SYNC_DELETES", "True") in {"true", "True", "1"}  # 源消息删除后同时删除目标中的消息
+
+# 规则条件 (when)
+REGEX_TIMEOUT = float(getenv("REGEX_TIMEOUT", "0.05"))  # 单个正则匹配的最长秒数，需要安装 regex 模块
+
+# 本地 HTTP 接口 (/metrics, /healthz, /readyz)
+HTTP_HOST = getenv("HTTP_HOST", "127.0.0.1")
+HTTP_PORT = int(getenv("HTTP_PORT", "0"))  # 0 为不启用
+
+# 看门狗 (/healthz, /readyz)
+WATCHDOG_LAG_LIMIT = float(getenv("WATCHDOG_LAG_LIMIT", "5"))  # 事件循环延迟超过多少秒视为不健康
+WATCHDOG_SILENCE_LIMIT = int(getenv("WATCHDOG_SILENCE_LIMIT", "0"))  # 多少秒收不到任何更新视为未就绪，0 为不检查
+WATCHDOG_RESTART = getenv("WATCHDOG_RESTART", "False") in {"true", "True", "1"}  # 收不到更新超过上面的时间后重新连接
+WATCHDOG_BACKLOG_LIMIT = int(getenv("WATCHDOG_BACKLOG_LIMIT", "0"))  # 待发送消息超过多少条视为未就绪，0 为不检查
+
+if SHARDED:
+    # 每个工作进程用自己的 session 登录同一账号，0 号进程沿用原来的
+    if SHARD > 0:
+        SESSION_NAME = f"{SESSION_NAME}-{SHARD}"
+        SENDER_SESSIONS = [f"{name}-{SHARD}" for name in SENDER_SESSIONS]
+    # 同一账号和同一目标的发送速度由各进程平分，不同源的规则可能发往同一目标
+    GLOBAL_SEND_RATE /= WORKERS
+    CHAT_SEND_RATE /= WORKERS
+    # 主进程在 HTTP_PORT 上汇总各进程的指标
+    if HTTP_PORT:
+        HTTP_HOST = "127.0.0.1"
+        HTTP_PORT += 1 + SHARD
+
 # 心跳配置
 HEARTBEAT_CHAT = getenv("HEARTBEAT_CHAT", "")  # "me" 或群组ID
 HEARTBEAT_INTERVAL = int(getenv("HEARTBEAT_INTERVAL", "30"))  # 分钟
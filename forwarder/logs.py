@@ -0,0 +1,78 @@
+"""Logging setup.
+
+With LOG_QUEUE the event loop only puts records on a queue and a background
+thread formats and writes them, so a slow terminal or Docker log pipe never
+blocks forwarding. LOG_FORMAT=json writes one JSON object per line, including
+the rule, source and destination that send logs pass as `extra`.
+"""
+import atexit
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Optional
+
+# 发送相关日志通过 extra 附带的字段
+EXTRA_FIELDS = ("rule", "source", "destination")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def __init__(self, shard: Optional[int] = None):
+        super().__init__()
+        self.shard = shard
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if self.shard is not None:
+            data["shard"] = self.shard
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Put records on the queue as they are. The default handler merges the
+    message and formats tracebacks before queueing, i.e. on the event loop."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(
+    level: str, json_format: bool, queued: bool, shard: Optional[int] = None
+) -> Optional[QueueListener]:
+    """Configure the root logger, returns the listener thread when queued"""
+    handler = logging.StreamHandler()
+    if json_format:
+        handler.setFormatter(JsonFormatter(shard))
+    else:
+        handler.setFormatter(
+            logging.Formatter(
+                "[ %(asctime)s: %(levelname)-8s ] "
+                + (f"shard-{shard} " if shard is not None else "")
+                + "%(name)-20s - %(message)s"
+            )
+        )
+
+    if not queued:
+        logging.basicConfig(level=level, handlers=[handler])
+        return None
+
+    queue = SimpleQueue()
+    listener = QueueListener(queue, handler)
+    logging.basicConfig(level=level, handlers=[_DeferredQueueHandler(queue)])
+    listener.start()
+    # 退出前写完队列里剩下的日志
+    atexit.register(listener.stop)
+    return listener
@@ -1,13 +1,45 @@
 import importlib
+from os import path, remove
 
-from forwarder import LOGGER, app
+from forwarder import DATA_DIR, LOGGER, SHARD, SHARDED, WORKERS, app
 from forwarder.modules import ALL_MODULES
 
-for module in ALL_MODULES:
-    importlib.import_module("forwarder.modules." + module)
+# 多进程模式下命令只由 0 号进程处理，其余进程只转发
+WORKER_MODULES = ["forward"]
+
+READY_FILE = "ready"
+
+
+def load_modules():
+    modules = ALL_MODULES if SHARD <= 0 else [m for m in ALL_MODULES if m in WORKER_MODULES]
+    for module in modules:
+        importlib.import_module("forwarder.modules." + module)
+    LOGGER.info("Successfully loaded modules: " + str(modules))
 
 
 def run():
-    LOGGER.info("Successfully loaded modules: " + str(ALL_MODULES))
+    if WORKERS > 1 and not SHARDED:
+        from forwarder import supervisor
+
+        supervisor.run()
+        return
+
+    load_modules()
+
+    if SHARDED:
+        from forwarder.utils import on_shutdown, on_startup
+
+        ready_file = path.join(DATA_DIR, READY_FILE)
+
+        # 登录完成后通知主进程，主进程再启动下一个
+        @on_startup
+        async def mark_ready():
+            open(ready_file, "w").close()
+
+        @on_shutdown
+        async def clear_ready():
+            if path.exists(ready_file):
+                remove(ready_file)
+
     LOGGER.info("Starting userbot...")
     app.run()
@@ -1,22 +1,21 @@
 import json
+from datetime import datetime
+
 from pyrogram import filters
 from pyrogram.types import Message
 from pyrogram.enums import ParseMode
 
-from forwarder import OWNER_ID, app, CONFIG, LOGGER
-
-CONFIG_FILE = "chat_list.json"
+from forwarder import OWNER_ID, app, CONFIG
+from forwarder.utils import backfill, config_store, parse_config, reply_urgently
 
 
 def save_config():
-    """保存配置到文件"""
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(CONFIG, f, indent=4, ensure_ascii=False)
-    LOGGER.info("Configuration saved to chat_list.json")
+    """保存配置到文件 (后台写入，短时间内的多次修改合并为一次)"""
+    config_store.save()
 
 
 def reload_forward_handler():
-    """重新加载转发处理器的源聊天列表"""
+    """重新加载转发规则 (只重建有变化的规则)"""
     from forwarder.utils.chat import reload_config
     reload_config()
 
@@ -33,7 +32,8 @@ async def add_forward(client, message: Message):
     args = message.text.split()[1:]
 
     if len(args) < 2:
-        return await message.reply(
+        return await reply_urgently(
+            message,
             "**用法:** `/add <源ID> <目标ID> [过滤词] [黑名单]`\n\n"
             "**示例:**\n"
             "`/add -1001234567890 -1009876543210`\n"
@@ -47,7 +47,7 @@ async def add_forward(client, message: Message):
         source = int(args[0])
         destination = int(args[1])
     except ValueError:
-        return await message.reply("源ID和目标ID必须是数字")
+        return await reply_urgently(message, "源ID和目标ID必须是数字")
 
     # 构建配置
     new_config = {
@@ -76,14 +76,14 @@ async def add_forward(client, message: Message):
     if new_config.get("blacklist"):
         result += f"\n黑名单: {', '.join(new_config['blacklist'])}"
 
-    await message.reply(result, parse_mode=ParseMode.MARKDOWN)
+    await reply_urgently(message, result, parse_mode=ParseMode.MARKDOWN)
 
 
 @app.on_message(filters.command("list") & filters.user(OWNER_ID))
 async def list_forwards(client, message: Message):
     """列出所有转发规则"""
     if not CONFIG:
-        return await message.reply("当前没有转发规则")
+        return await reply_urgently(message, "当前没有转发规则")
 
     result = "**当前转发规则:**\n\n"
     for i, config in enumerate(CONFIG, 1):
@@ -95,9 +95,15 @@ async def list_forwards(client, message: Message):
             result += f"  过滤词: {', '.join(config['filters'])}\n"
         if config.get("blacklist"):
             result += f"  黑名单: {', '.join(config['blacklist'])}\n"
+        if config.get("when"):
+            result += f"  条件: `{json.dumps(config['when'], ensure_ascii=False)}`\n"
+        if config.get("priority"):
+            result += f"  优先级: {config['priority']}\n"
+        if config.get("max_backlog"):
+            result += f"  积压上限: {config['max_backlog']} ({config.get('overflow', 'drop_oldest')})\n"
         result += "\n"
 
-    await message.reply(result, parse_mode=ParseMode.MARKDOWN)
+    await reply_urgently(message, result, parse_mode=ParseMode.MARKDOWN)
 
 
 @app.on_message(filters.command("remove") & filters.user(OWNER_ID))
@@ -110,7 +116,8 @@ async def remove_forward(client, message: Message):
     args = message.text.split()[1:]
 
     if not args:
-        return await message.reply(
+        return await reply_urgently(
+            message,
             "**用法:** `/remove <规则编号>`\n"
             "使用 /list 查看规则编号",
             parse_mode=ParseMode.MARKDOWN
@@ -119,16 +126,17 @@ async def remove_forward(client, message: Message):
     try:
         index = int(args[0]) - 1
     except ValueError:
-        return await message.reply("规则编号必须是数字")
+        return await reply_urgently(message, "规则编号必须是数字")
 
     if index < 0 or index >= len(CONFIG):
-        return await message.reply(f"规则编号无效，当前共有 {len(CONFIG)} 条规则")
+        return await reply_urgently(message, f"规则编号无效，当前共有 {len(CONFIG)} 条规则")
 
     removed = CONFIG.pop(index)
     save_config()
     reload_forward_handler()
 
-    await message.reply(
+    await reply_urgently(
+        message,
         f"**已删除规则 #{index + 1}**\n"
         f"源: `{removed['source']}`",
         parse_mode=ParseMode.MARKDOWN
@@ -145,7 +153,8 @@ async def add_destination(client, message: Message):
     args = message.text.split()[1:]
 
     if len(args) < 2:
-        return await message.reply(
+        return await reply_urgently(
+            message,
             "**用法:** `/adddest <规则编号> <目标ID>`\n"
             "示例: `/adddest 1 -1009876543210`",
             parse_mode=ParseMode.MARKDOWN
@@ -155,18 +164,20 @@ async def add_destination(client, message: Message):
         index = int(args[0]) - 1
         dest = int(args[1])
     except ValueError:
-        return await message.reply("规则编号和目标ID必须是数字")
+        return await reply_urgently(message, "规则编号和目标ID必须是数字")
 
     if index < 0 or index >= len(CONFIG):
-        return await message.reply(f"规则编号无效，当前共有 {len(CONFIG)} 条规则")
+        return await reply_urgently(message, f"规则编号无效，当前共有 {len(CONFIG)} 条规则")
 
     if dest not in CONFIG[index]["destination"]:
         CONFIG[index]["destination"].append(dest)
         save_config()
         reload_forward_handler()
-        await message.reply(f"已为规则 #{index + 1} 添加目标: `{dest}`", parse_mode=ParseMode.MARKDOWN)
+        await reply_urgently(
+            message, f"已为规则 #{index + 1} 添加目标: `{dest}`", parse_mode=ParseMode.MARKDOWN
+        )
     else:
-        await message.reply("该目标已存在")
+        await reply_urgently(message, "该目标已存在")
 
 
 @app.on_message(filters.command("addfilter") & filters.user(OWNER_ID))
@@ -179,7 +190,8 @@ async def add_filter(client, message: Message):
     args = message.text.split()[1:]
 
     if len(args) < 2:
-        return await message.reply(
+        return await reply_urgently(
+            message,
             "**用法:** `/addfilter <规则编号> <过滤词>`\n"
             "示例: `/addfilter 1 BTC,ETH`",
             parse_mode=ParseMode.MARKDOWN
@@ -188,14 +200,14 @@ async def add_filter(client, message: Message):
     try:
         index = int(args[0]) - 1
     except ValueError:
-        return await message.reply("规则编号必须是数字")
+        return await reply_urgently(message, "规则编号必须是数字")
 
     if index < 0 or index >= len(CONFIG):
-        return await message.reply(f"规则编号无效，当前共有 {len(CONFIG)} 条规则")
+        return await reply_urgently(message, f"规则编号无效，当前共有 {len(CONFIG)} 条规则")
 
     new_filters = [f.strip() for f in args[1].split(",") if f.strip()]
     if not new_filters:
-        return await message.reply("请提供有效的过滤词")
+        return await reply_urgently(message, "请提供有效的过滤词")
 
     if "filters" not in CONFIG[index]:
         CONFIG[index]["filters"] = []
@@ -209,9 +221,9 @@ async def add_filter(client, message: Message):
     if added:
         save_config()
         reload_forward_handler()
-        await message.reply(f"已为规则 #{index + 1} 添加过滤词: {', '.join(added)}")
+        await reply_urgently(message, f"已为规则 #{index + 1} 添加过滤词: {', '.join(added)}")
     else:
-        await message.reply("所有过滤词已存在")
+        await reply_urgently(message, "所有过滤词已存在")
 
 
 @app.on_message(filters.command("addblack") & filters.user(OWNER_ID))
@@ -224,7 +236,8 @@ async def add_blacklist(client, message: Message):
     args = message.text.split()[1:]
 
     if len(args) < 2:
-        return await message.reply(
+        return await reply_urgently(
+            message,
             "**用法:** `/addblack <规则编号> <黑名单词>`\n"
             "示例: `/addblack 1 广告,推广`",
             parse_mode=ParseMode.MARKDOWN
@@ -233,14 +246,14 @@ async def add_blacklist(client, message: Message):
     try:
         index = int(args[0]) - 1
     except ValueError:
-        return await message.reply("规则编号必须是数字")
+        return await reply_urgently(message, "规则编号必须是数字")
 
     if index < 0 or index >= len(CONFIG):
-        return await message.reply(f"规则编号无效，当前共有 {len(CONFIG)} 条规则")
+        return await reply_urgently(message, f"规则编号无效，当前共有 {len(CONFIG)} 条规则")
 
     new_blacklist = [b.strip() for b in args[1].split(",") if b.strip()]
     if not new_blacklist:
-        return await message.reply("请提供有效的黑名单词")
+        return await reply_urgently(message, "请提供有效的黑名单词")
 
     if "blacklist" not in CONFIG[index]:
         CONFIG[index]["blacklist"] = []
@@ -254,9 +267,9 @@ async def add_blacklist(client, message: Message):
     if added:
         save_config()
         reload_forward_handler()
-        await message.reply(f"已为规则 #{index + 1} 添加黑名单: {', '.join(added)}")
+        await reply_urgently(message, f"已为规则 #{index + 1} 添加黑名单: {', '.join(added)}")
     else:
-        await message.reply("所有黑名单词已存在")
+        await reply_urgently(message, "所有黑名单词已存在")
 
 
 @app.on_message(filters.command("clearfilter") & filters.user(OWNER_ID))
@@ -268,23 +281,25 @@ async def clear_filter(client, message: Message):
     args = message.text.split()[1:]
 
     if not args:
-        return await message.reply("**用法:** `/clearfilter <规则编号>`", parse_mode=ParseMode.MARKDOWN)
+        return await reply_urgently(
+            message, "**用法:** `/clearfilter <规则编号>`", parse_mode=ParseMode.MARKDOWN
+        )
 
     try:
         index = int(args[0]) - 1
     except ValueError:
-        return await message.reply("规则编号必须是数字")
+        return await reply_urgently(message, "规则编号必须是数字")
 
     if index < 0 or index >= len(CONFIG):
-        return await message.reply(f"规则编号无效")
+        return await reply_urgently(message, f"规则编号无效")
 
     if "filters" in CONFIG[index]:
         del CONFIG[index]["filters"]
         save_config()
         reload_forward_handler()
-        await message.reply(f"已清除规则 #{index + 1} 的所有过滤词")
+        await reply_urgently(message, f"已清除规则 #{index + 1} 的所有过滤词")
     else:
-        await message.reply("该规则没有过滤词")
+        await reply_urgently(message, "该规则没有过滤词")
 
 
 @app.on_message(filters.command("clearblack") & filters.user(OWNER_ID))
@@ -296,20 +311,129 @@ async def clear_blacklist(client, message: Message):
     args = message.text.split()[1:]
 
     if not args:
-        return await message.reply("**用法:** `/clearblack <规则编号>`", parse_mode=ParseMode.MARKDOWN)
+        return await reply_urgently(
+            message, "**用法:** `/clearblack <规则编号>`", parse_mode=ParseMode.MARKDOWN
+        )
 
     try:
         index = int(args[0]) - 1
     except ValueError:
-        return await message.reply("规则编号必须是数字")
+        return await reply_urgently(message, "规则编号必须是数字")
 
     if index < 0 or index >= len(CONFIG):
-        return await message.reply(f"规则编号无效")
+        return await reply_urgently(message, f"规则编号无效")
 
     if "blacklist" in CONFIG[index]:
         del CONFIG[index]["blacklist"]
         save_config()
         reload_forward_handler()
-        await message.reply(f"已清除规则 #{index + 1} 的所有黑名单词")
+        await reply_urgently(message, f"已清除规则 #{index + 1} 的所有黑名单词")
+    else:
+        await reply_urgently(message, "该规则没有黑名单")
+
+
+@app.on_message(filters.command("import") & filters.user(OWNER_ID))
+async def import_rules(client, message: Message):
+    """
+    批量导入转发规则 (追加到现有规则之后)
+    用法: /import <JSON 数组>
+    或者发送/回复一个 .json 文件，并附带 /import
+    """
+    document_message = message if message.document else message.reply_to_message
+    if document_message and document_message.document:
+        data = await client.download_media(document_message, in_memory=True)
+        text = bytes(data.getbuffer()).decode("utf-8", errors="replace")
     else:
-        await message.reply("该规则没有黑名单")
+        parts = (message.text or message.caption or "").split(maxsplit=1)
+        text = parts[1] if len(parts) > 1 else ""
+
+    if not text.strip():
+        return await reply_urgently(
+            message,
+            "**用法:** `/import <JSON 数组>`\n"
+            "或者发送/回复一个 `.json` 文件，并附带 `/import`\n\n"
+            "格式与 chat_list.json 相同，例如:\n"
+            '`[{"source": -1001234567890, "destination": [-1009876543210]}]`',
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+    try:
+        new_rules = json.loads(text)
+        # 与现有规则一起校验，全部有效才写入
+        parse_config(CONFIG + new_rules if isinstance(new_rules, list) else new_rules)
+    except ValueError as err:
+        return await reply_urgently(message, f"导入失败: {err}")
+
+    if not new_rules:
+        return await reply_urgently(message, "没有需要导入的规则")
+
+    first = len(CONFIG) + 1
+    CONFIG.extend(new_rules)
+    save_config()
+    reload_forward_handler()
+
+    await reply_urgently(message, f"已导入 {len(new_rules)} 条规则 (#{first} - #{len(CONFIG)})")
+
+
+@app.on_message(filters.command("backfill") & filters.user(OWNER_ID))
+async def backfill_rule(client, message: Message):
+    """
+    把源的历史消息按规则补发到目标 (只转发通过过滤的消息，实时转发优先)
+    用法: /backfill <规则编号> [起始ID] [结束ID|日期]
+    示例: /backfill 1
+    示例: /backfill 1 1000 5000
+    示例: /backfill 1 1 2024-01-31
+    控制: /backfill pause | resume | cancel
+    """
+    args = message.text.split()[1:]
+    job = backfill.job
+
+    if not args:
+        if job is not None:
+            return await reply_urgently(message, job.describe(), parse_mode=ParseMode.MARKDOWN)
+        return await reply_urgently(
+            message,
+            "**用法:** `/backfill <规则编号> [起始ID] [结束ID|日期]`\n"
+            "示例: `/backfill 1 1000 5000`\n"
+            "示例: `/backfill 1 1 2024-01-31`\n\n"
+            "暂停/继续/取消: `/backfill pause|resume|cancel`",
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+    action = args[0].lower()
+    if action in ("pause", "resume", "cancel"):
+        if not backfill.active:
+            return await reply_urgently(message, "当前没有补发任务")
+        if action == "pause":
+            job.pause()
+        elif action == "resume":
+            job.resume()
+        else:
+            await job.cancel()
+        await job.report(force=True)
+        return await reply_urgently(message, job.describe(), parse_mode=ParseMode.MARKDOWN)
+
+    if backfill.active:
+        return await reply_urgently(
+            message, "已有补发任务在进行，请先等待完成或 `/backfill cancel`", parse_mode=ParseMode.MARKDOWN
+        )
+
+    try:
+        index = int(args[0]) - 1
+        first_id = int(args[1]) if len(args) >= 2 else 1
+        end_id, end_date = None, None
+        if len(args) >= 3:
+            if args[2].isdigit():
+                end_id = int(args[2])
+            else:
+                end_date = datetime.strptime(args[2], "%Y-%m-%d")
+    except ValueError:
+        return await reply_urgently(message, "规则编号和消息ID必须是数字，日期格式为 YYYY-MM-DD")
+
+    if index < 0 or index >= len(CONFIG):
+        return await reply_urgently(message, f"规则编号无效，当前共有 {len(CONFIG)} 条规则")
+    if first_id < 1 or (end_id is not None and end_id < first_id):
+        return await reply_urgently(message, "消息ID范围无效")
+
+    status = await reply_urgently(message, f"开始补发规则 #{index + 1} ...")
+    await backfill.start(CONFIG[index], index + 1, first_id, end_id, end_date, status)
@@ -3,6 +3,7 @@ from pyrogram.types import Message
 from pyrogram.enums import ParseMode
 
 from forwarder import app, OWNER_ID
+from forwarder.utils import reply_urgently
 
 PM_START_TEXT = """
 Hey {}, I'm {}!
@@ -18,6 +19,8 @@ PM_HELP_TEXT = """
 • `/start` - 启动机器人
 • `/help` - 显示此帮助信息
 • `/id` - 获取当前聊天/用户ID
+• `/stats` - 查看转发统计
+• `/profile [秒数]` - 分析运行中的进程耗时
 
 **配置管理:**
 • `/list` - 查看所有转发规则
@@ -28,6 +31,9 @@ PM_HELP_TEXT = """
 • `/addblack <编号> <词1,词2>` - 添加黑名单词
 • `/clearfilter <编号>` - 清除规则的过滤词
 • `/clearblack <编号>` - 清除规则的黑名单
+• `/import <JSON>` - 批量导入规则 (也可附带 .json 文件)
+• `/backfill <编号> [起始ID] [结束ID|日期]` - 补发历史消息
+• `/backfill pause|resume|cancel` - 暂停/继续/取消补发
 
 **使用示例:**
 ```
@@ -55,14 +61,15 @@ async def start(client, message: Message):
 
     if chat.type.value == "private":
         me = await client.get_me()
-        await message.reply(
+        await reply_urgently(
+            message,
             PM_START_TEXT.format(user.first_name, me.first_name),
             parse_mode=ParseMode.HTML,
         )
     else:
-        await message.reply("I'm up and running!")
+        await reply_urgently(message, "I'm up and running!")
 
 
 @app.on_message(filters.command("help") & filters.user(OWNER_ID))
 async def help_command(client, message: Message):
-    await message.reply(PM_HELP_TEXT)
+    await reply_urgently(message, PM_HELP_TEXT)
@@ -1,61 +1,395 @@
 import asyncio
-from typing import Union
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 from pyrogram import filters
+from pyrogram.errors import FloodWait, MessageNotModified
 from pyrogram.types import Message
-from pyrogram.errors import FloodWait
 
-from forwarder import app, REMOVE_TAG, LOGGER
-from forwarder.utils import get_destination, get_config, predicate_text
+from forwarder import (
+    app,
+    LOGGER,
+    ALBUM_WAIT,
+    CATCHUP_CONCURRENCY,
+    CATCHUP_INTERVAL,
+    CATCHUP_LIMIT,
+    SYNC_DELETES,
+    SYNC_EDITS,
+)
+from forwarder.utils import (
+    FILTER_TIME,
+    MESSAGES_FILTERED,
+    MESSAGES_MATCHED,
+    STAGE_TIME,
+    AlbumBuffer,
+    Sender,
+    checkpoints,
+    content_fingerprint,
+    get_route,
+    get_sources,
+    get_topic_id,
+    is_source,
+    message_map,
+    on_reconnect,
+    on_shutdown,
+    on_startup,
+    scheduler,
+    senders,
+    watchdog,
+)
 
+# 记住最近同步过的多少条编辑
+SYNCED_EDITS_SIZE = 10000
 
-async def send_message(
-    message: Message, chat_id: int, thread_id: int = None
-) -> Union[Message, None]:
-    if REMOVE_TAG:
-        return await message.copy(chat_id, reply_to_message_id=thread_id)
-    return await message.forward(chat_id)
 
+def route_messages(messages: List[Message], text: str, received: Optional[float] = None):
+    """根据规则过滤并写入发送队列，然后记录处理进度"""
+    first = messages[0]
+    topic = get_topic_id(first)
+    submit_messages(messages, text, topic, received)
+    # 未匹配的消息也算处理过，相册还没收齐时进度停在相册之前
+    checkpoints.advance(first.chat.id, topic, messages[-1].id, hold=albums.oldest(first.chat.id))
 
-# 获取所有需要监听的源聊天 ID
-source_chats = [config.source.get_id() for config in get_config()]
+
+def submit_messages(
+    messages: List[Message], text: str, topic: Optional[int], received: Optional[float] = None
+):
+    first = messages[0]
+    started = time.perf_counter()
+    route = get_route(first.chat.id, topic)
+    routed = time.perf_counter()
+    STAGE_TIME.observe(routed - started, "route")
+    if route is None:
+        return
+
+    # 白名单和黑名单在一次扫描中完成，便宜的条件先判断
+    rules = route.match(text, messages)
+    filtered = time.perf_counter()
+    FILTER_TIME.observe(filtered - routed)
+
+    for rule in route.rules:
+        if rule in rules:
+            MESSAGES_MATCHED.inc(rule.label)
+        else:
+            MESSAGES_FILTERED.inc(rule.label)
+    if not rules:
+        return
+
+    # 只写入发送队列，由后台 worker 并发发送，同一目标内保持顺序
+    scheduler.submit(
+        first.chat.id,
+        [message.id for message in messages],
+        rules,
+        media_group=first.media_group_id,
+        fingerprint=content_fingerprint(messages) if scheduler.dedup is not None else None,
+        reply_to=first.reply_to_message_id if first.reply_to_message_id != topic else None,
+        media=any(message.media for message in messages),
+        received=received,
+    )
+    STAGE_TIME.observe(time.perf_counter() - filtered, "queue")
+
+
+def route_album(messages: List[Message], received: Optional[float] = None):
+    # 相册只按合并后的说明文字过滤一次
+    captions = "\n".join(message.caption for message in messages if message.caption)
+    route_messages(messages, captions, received)
+
+
+albums = AlbumBuffer(ALBUM_WAIT, route_album)
+
+
+@on_shutdown
+async def flush_albums():
+    albums.flush_all()
+
+
+async def source_filter(_, __, message: Message) -> bool:
+    # 每次读取当前的路由表，/add 或修改 chat_list.json 后无需重启
+    return message.chat is not None and is_source(message.chat.id)
+
+
+source_chats = filters.create(source_filter, "SourceChatsFilter")
+
+
+def handle_message(message: Message, received: Optional[float] = None):
+    # 相册的各项分开到达，收齐后一起发送
+    if message.media_group_id:
+        albums.add(message)
+        return
+
+    route_messages([message], message.text or message.caption or "", received)
+
+
+def route_history(messages: List[Message]):
+    """Filter and queue messages read from the chat history, oldest first"""
+    album: List[Message] = []
+    for message in messages:
+        if album and message.media_group_id != album[0].media_group_id:
+            route_album(album)
+            album = []
+        if message.empty or message.service:
+            continue
+        if message.media_group_id:
+            album.append(message)
+            continue
+        route_messages([message], message.text or message.caption or "")
+    if album:
+        route_album(album)
+
+
+# 读取历史失败后的重试次数，间隔从 CATCHUP_RETRY_DELAY 秒开始翻倍
+CATCHUP_RETRIES = 5
+CATCHUP_RETRY_DELAY = 10
+
+# 正在补发的源 -> 期间收到的实时消息，补发完成后再按顺序处理。
+# 导入时就登记有进度记录的源，启动后最早到达的消息也会排在补发之后
+_catching_up: Dict[int, List[Message]] = {}
+_catch_up_since: Dict[int, int] = {}
+# 读取历史失败的源 -> (进度, 之后第一条实时处理的消息)，两者之间的消息还没读到
+_unread: Dict[int, Tuple[int, Optional[int]]] = {}
+if CATCHUP_LIMIT > 0:
+    for source in get_sources():
+        since = checkpoints.get(source)
+        if since is not None:
+            _catching_up[source] = []
+            _catch_up_since[source] = since
+
+
+async def _read_history(chat_id: int, since: int, until: Optional[int]) -> List[Message]:
+    """The messages of a source posted after `since` and before `until`, newest first"""
+    history: List[Message] = []
+    async for message in app.get_chat_history(chat_id, limit=CATCHUP_LIMIT, offset_id=until or 0):
+        if message.id <= since:
+            break
+        history.append(message)
+    else:
+        if len(history) >= CATCHUP_LIMIT:
+            LOGGER.warning(
+                f"More than {CATCHUP_LIMIT} missed messages in {chat_id},"
+                f" only the latest {CATCHUP_LIMIT} are forwarded"
+            )
+    return history
+
+
+async def catch_up(chat_id: int, since: int, semaphore: asyncio.Semaphore):
+    """Forward the messages of a source posted after `since`, then resume live handling"""
+    until = _unread[chat_id][1] if chat_id in _unread else None
+    history: Optional[List[Message]] = None
+    for attempt in range(CATCHUP_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(CATCHUP_RETRY_DELAY * 2 ** (attempt - 1))
+        # 历史从新到旧读取，中途失败时缺的是较早的消息。只发已读到的部分会让进度越过它们，
+        # 所以整体重读，期间实时消息继续缓存，进度不变
+        try:
+            async with semaphore:
+                history = await _read_history(chat_id, since, until)
+            break
+        except Exception as err:
+            LOGGER.warning(
+                f"Failed to read the history of {chat_id} since message {since}"
+                f" (attempt {attempt + 1}/{CATCHUP_RETRIES + 1}): {err}"
+            )
+
+    buffered = _catching_up.pop(chat_id, [])
+    failed = history is None
+    if failed:
+        # 先恢复实时处理，但进度停在 since，之后每次 check_gaps 只重读没读到的这一段
+        if until is None and buffered:
+            until = min(message.id for message in buffered)
+        _unread[chat_id] = (since, until)
+        checkpoints.hold(chat_id, since)
+        LOGGER.error(
+            f"Failed to read the messages of {chat_id} posted after message {since},"
+            " retrying on the next gap check"
+        )
+        history = []
+
+    history.reverse()
+    route_history(history)
+    if history:
+        LOGGER.info(f"Caught up on {len(history)} messages in {chat_id}")
+
+    last = history[-1].id if history else since
+    for message in buffered:
+        if message.id > last:
+            handle_message(message)
+
+    if not failed and _unread.pop(chat_id, None) is not None:
+        checkpoints.release(chat_id, hold=albums.oldest(chat_id))
 
 
-@app.on_message(filters.chat(source_chats) & ~filters.service)
+async def catch_up_all(sources: Dict[int, int]):
+    semaphore = asyncio.Semaphore(max(1, CATCHUP_CONCURRENCY))
+    await asyncio.gather(*(catch_up(chat_id, since, semaphore) for chat_id, since in sources.items()))
+
+
+async def check_gaps():
+    """补发连接中断期间漏掉的消息"""
+    sources = {}
+    for source in get_sources():
+        since = _unread[source][0] if source in _unread else checkpoints.get(source)
+        # 还在收集的相册会出现在历史里，下一轮再检查
+        if since is None or source in _catching_up or albums.oldest(source) is not None:
+            continue
+        _catching_up[source] = []
+        sources[source] = since
+    await catch_up_all(sources)
+
+
+async def watch_gaps():
+    """定期检查是否漏掉消息"""
+    while True:
+        await asyncio.sleep(CATCHUP_INTERVAL)
+        await check_gaps()
+
+
+if CATCHUP_LIMIT > 0:
+
+    @on_startup
+    async def start_catch_up():
+        if _catch_up_since:
+            LOGGER.info(f"Catching up on {len(_catch_up_since)} sources")
+            asyncio.create_task(catch_up_all(_catch_up_since))
+        if CATCHUP_INTERVAL > 0:
+            asyncio.create_task(watch_gaps())
+
+    @on_reconnect
+    async def catch_up_after_reconnect():
+        asyncio.create_task(check_gaps())
+
+
+@app.on_message(source_chats & ~filters.service)
 async def forwarder(client, message: Message):
     if message is None or message.chat is None:
         return
-    source = message.chat
-
-    # 获取 topic_id (如果是论坛)
-    topic_id = None
-    is_forum = getattr(source, 'is_forum', False)
-    if hasattr(message, 'topic') and message.topic:
-        topic_id = message.topic.id
-    elif hasattr(message, 'reply_to_top_message_id') and message.reply_to_top_message_id:
-        topic_id = message.reply_to_top_message_id
-    elif hasattr(message, 'reply_to_message_id') and message.reply_to_message_id and is_forum:
-        topic_id = message.reply_to_message_id
-
-    dest = get_destination(source.id, topic_id)
-
-    for config in dest:
-        # 检查白名单过滤器
-        if config.filters:
-            if not predicate_text(config.filters, message.text or message.caption or ""):
-                continue
-        # 检查黑名单
-        if config.blacklist:
-            if predicate_text(config.blacklist, message.text or message.caption or ""):
-                continue
+    received = time.monotonic()
+
+    watchdog.seen(message.chat.id)
+
+    # 补发完成前先缓存
+    pending = _catching_up.get(message.chat.id)
+    if pending is not None:
+        pending.append(message)
+        return
+    # 读取历史失败后第一条实时消息，之前的消息留给下次 check_gaps
+    unread = _unread.get(message.chat.id)
+    if unread is not None and unread[1] is None:
+        _unread[message.chat.id] = (unread[0], message.id)
+
+    started = time.perf_counter()
+    handle_message(message, received)
+    STAGE_TIME.observe(time.perf_counter() - started, "handler")
+
 
-        for chat in config.destination:
-            LOGGER.debug(f"Forwarding message from {source.id} to {chat}")
-            try:
-                await send_message(message, chat.get_id(), chat.get_topic())
-            except FloodWait as err:
-                LOGGER.warning(f"Rate limited, retrying in {err.value} seconds")
-                await asyncio.sleep(err.value + 0.2)
-                await send_message(message, chat.get_id(), chat.get_topic())
-            except Exception as err:
-                LOGGER.error(f"Failed to forward message from {source.id} to {chat} due to {err}")
+async def _throttle(chat_id: int, account: str) -> Optional[Sender]:
+    """等待发送账号和目标的限速，账号已不可用时返回 None"""
+    sender = senders.get(account)
+    if sender is None or sender.disabled:
+        return None
+    await sender.bucket.acquire()
+    await scheduler.bucket(chat_id).acquire()
+    return sender
+
+
+# (源, 消息) -> 已同步的 edit_date，反应和浏览数变化也会触发编辑更新
+_synced_edits: "OrderedDict[Tuple[int, int], datetime]" = OrderedDict()
+
+
+async def sync_edit(message: Message):
+    """把源消息的修改同步到复制出的消息，转发的消息无法修改"""
+    key = (message.chat.id, message.id)
+    if message.edit_date is None or _synced_edits.get(key) == message.edit_date:
+        return
+    _synced_edits[key] = message.edit_date
+    _synced_edits.move_to_end(key)
+    while len(_synced_edits) > SYNCED_EDITS_SIZE:
+        _synced_edits.popitem(last=False)
+
+    for chat_id, dest_id, account, copied in message_map.get(message.chat.id, message.id):
+        if not copied:
+            continue
+        sender = await _throttle(chat_id, account)
+        if sender is None:
+            continue
+        fields = {"source": message.chat.id, "destination": chat_id}
+        try:
+            if message.text is not None:
+                await sender.client.edit_message_text(
+                    chat_id, dest_id, message.text, entities=message.entities
+                )
+            elif message.media:
+                await sender.client.edit_message_caption(
+                    chat_id,
+                    dest_id,
+                    message.caption or "",
+                    caption_entities=message.caption_entities,
+                )
+        except MessageNotModified:
+            pass
+        except FloodWait as err:
+            scheduler.bucket(chat_id).penalize(err.value + 0.2)
+            LOGGER.warning(
+                "Rate limited on %s, edit of %s not synced", chat_id, key, extra=fields
+            )
+        except Exception as err:
+            LOGGER.warning(
+                "Failed to sync the edit of %s to %s: %s", key, chat_id, err, extra=fields
+            )
+
+
+async def sync_delete(source: int, message_ids: List[int]):
+    """删除源消息在各目标中的副本"""
+    copies: Dict[Tuple[int, str], List[int]] = {}
+    for message_id in message_ids:
+        for chat_id, dest_id, account, _ in message_map.get(source, message_id):
+            copies.setdefault((chat_id, account), []).append(dest_id)
+    message_map.forget(source, message_ids)
+
+    for (chat_id, account), dest_ids in copies.items():
+        sender = await _throttle(chat_id, account)
+        if sender is None:
+            continue
+        try:
+            await sender.client.delete_messages(chat_id, dest_ids)
+        except FloodWait as err:
+            scheduler.bucket(chat_id).penalize(err.value + 0.2)
+            LOGGER.warning(
+                "Rate limited on %s, deletion of %d messages not synced",
+                chat_id,
+                len(dest_ids),
+                extra={"source": source, "destination": chat_id},
+            )
+        except Exception as err:
+            LOGGER.warning(
+                "Failed to delete %d messages in %s: %s",
+                len(dest_ids),
+                chat_id,
+                err,
+                extra={"source": source, "destination": chat_id},
+            )
+
+
+if message_map is not None and SYNC_EDITS:
+
+    @app.on_edited_message(source_chats & ~filters.service)
+    async def edited(client, message: Message):
+        if message is None or message.chat is None:
+            return
+        # 限速时可能要等待，不占用处理更新的 worker
+        asyncio.create_task(sync_edit(message))
+
+
+if message_map is not None and SYNC_DELETES:
+
+    @app.on_deleted_messages(source_chats)
+    async def deleted(client, messages: List[Message]):
+        # 只有频道和超级群组的删除更新带有 chat
+        by_source: Dict[int, List[int]] = {}
+        for message in messages:
+            if message is None or message.chat is None:
+                continue
+            by_source.setdefault(message.chat.id, []).append(message.id)
+        for source, message_ids in by_source.items():
+            asyncio.create_task(sync_delete(source, message_ids))
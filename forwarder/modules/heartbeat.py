@@ -2,6 +2,7 @@ import asyncio
 from datetime import datetime
 
 from forwarder import app, HEARTBEAT_CHAT, HEARTBEAT_INTERVAL, LOGGER
+from forwarder.utils import on_startup
 
 
 def get_chat_id():
@@ -47,11 +48,6 @@ async def heartbeat_loop():
 if HEARTBEAT_CHAT:
     LOGGER.info(f"Heartbeat configured: every {HEARTBEAT_INTERVAL} minutes to {HEARTBEAT_CHAT}")
 
-    # 使用 Pyrogram 的 start handler
-    original_start = app.start
-
-    async def start_with_heartbeat():
-        await original_start()
+    @on_startup
+    async def start_heartbeat():
         asyncio.create_task(heartbeat_loop())
-
-    app.start = start_with_heartbeat
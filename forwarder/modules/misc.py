@@ -3,6 +3,7 @@ from pyrogram.types import Message
 from pyrogram.enums import ParseMode, ChatType
 
 from forwarder import OWNER_ID, app
+from forwarder.utils import reply_urgently
 
 
 @app.on_message(filters.command("id") & (filters.user(OWNER_ID) | filters.channel))
@@ -10,7 +11,9 @@ async def get_id(client, message: Message):
     chat = message.chat
 
     if chat.type == ChatType.PRIVATE:
-        return await message.reply(f"Your ID is `{chat.id}`", parse_mode=ParseMode.MARKDOWN)
+        return await reply_urgently(
+            message, f"Your ID is `{chat.id}`", parse_mode=ParseMode.MARKDOWN
+        )
 
     result = f"Chat ID: `{chat.id}`"
 
@@ -44,4 +47,4 @@ async def get_id(client, message: Message):
             if forwarder_user:
                 result += f"\nThe forwarder ({forwarder_user.first_name}) ID: `{forwarder_user.id}`"
 
-    return await message.reply(result, parse_mode=ParseMode.MARKDOWN)
+    return await reply_urgently(message, result, parse_mode=ParseMode.MARKDOWN)
@@ -0,0 +1,153 @@
+import asyncio
+
+from pyrogram import filters
+from pyrogram.types import Message
+from pyrogram.enums import ParseMode
+
+from forwarder import LOGGER, OWNER_ID, HTTP_HOST, HTTP_PORT, SHARDED, app
+from forwarder.utils import (
+    FILTER_TIME,
+    FLOODWAIT_SECONDS,
+    MESSAGES_FAILED,
+    MESSAGES_FILTERED,
+    MESSAGES_MATCHED,
+    MESSAGES_SENT,
+    SENDER_MESSAGES,
+    SEND_LATENCY,
+    STAGE_TIME,
+    edit_urgently,
+    profiler,
+    reply_urgently,
+    scheduler,
+    senders,
+    top_functions,
+)
+
+# /stats 中每类最多列出几项
+TOP_N = 10
+
+# /profile 的默认和最长分析秒数，以及列出的函数数
+PROFILE_SECONDS = 30
+PROFILE_MAX_SECONDS = 600
+PROFILE_TOP = 15
+
+# /stats 中显示耗时的处理阶段
+STAGES = (("handler", "处理"), ("route", "路由"), ("queue", "入队"), ("send", "发送"))
+
+
+def _by_label(values: dict, index: int) -> dict:
+    totals = {}
+    for labels, value in values.items():
+        totals[labels[index]] = totals.get(labels[index], 0) + value
+    return totals
+
+
+def _top(totals: dict) -> list:
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:TOP_N]
+
+
+def _quantile(histogram, q: float, *labels: str) -> str:
+    value = histogram.quantile(q, *labels)
+    if value is None:
+        return "-"
+    if value == float("inf"):
+        return f">{histogram.buckets[-1]:g}s"
+    return f"≤{value:g}s"
+
+
+@app.on_message(filters.command("stats") & filters.user(OWNER_ID))
+async def stats(client, message: Message):
+    """显示转发统计"""
+    result = "**转发统计** (自启动以来)\n\n"
+    result += f"待发送: `{scheduler.pending()}`  失败放弃: `{scheduler.dead()}`\n"
+    result += f"FloodWait 总计: `{FLOODWAIT_SECONDS.total():g}s`\n"
+    result += (
+        f"发送延迟 p50/p95: {_quantile(SEND_LATENCY, 0.5)} / {_quantile(SEND_LATENCY, 0.95)}\n"
+    )
+    result += f"过滤耗时 p95: {_quantile(FILTER_TIME, 0.95)}\n"
+    result += (
+        "各阶段耗时 p95: "
+        + " ".join(f"{name} {_quantile(STAGE_TIME, 0.95, stage)}" for stage, name in STAGES)
+        + "\n"
+    )
+
+    if len(senders.senders) > 1:
+        result += "\n**发送账号** (发送数):\n"
+        for sender in senders.senders:
+            state = " (已停用)" if sender.disabled else " (限流中)" if sender.bucket.paused else ""
+            result += f"`{sender.name}`: {SENDER_MESSAGES.values.get((sender.name,), 0):g}{state}\n"
+
+    matched = MESSAGES_MATCHED.values
+    filtered = MESSAGES_FILTERED.values
+    sent = _by_label(MESSAGES_SENT.values, 0)
+    failed = _by_label(MESSAGES_FAILED.values, 0)
+    rules = {labels[0] for labels in list(matched) + list(filtered)} | set(sent)
+    if rules:
+        result += "\n**规则** (匹配/过滤/发送/失败):\n"
+        ranked = sorted(rules, key=lambda rule: matched.get((rule,), 0), reverse=True)[:TOP_N]
+        for rule in ranked:
+            result += (
+                f"`{rule}`: {matched.get((rule,), 0):g} / {filtered.get((rule,), 0):g}"
+                f" / {sent.get(rule, 0):g} / {failed.get(rule, 0):g}\n"
+            )
+
+    destinations = _by_label(MESSAGES_SENT.values, 1)
+    if destinations:
+        failed_by_dest = _by_label(MESSAGES_FAILED.values, 1)
+        flood = _by_label(FLOODWAIT_SECONDS.values, 0)
+        result += "\n**目标** (发送/失败/FloodWait):\n"
+        for destination, count in _top(destinations):
+            result += (
+                f"`{destination}`: {count:g} / {failed_by_dest.get(destination, 0):g}"
+                f" / {flood.get(destination, 0):g}s\n"
+            )
+
+    if SHARDED:
+        result += "\n只包括 0 号进程，各进程的汇总见 /metrics"
+    elif HTTP_PORT:
+        result += f"\n完整指标: `http://{HTTP_HOST}:{HTTP_PORT}/metrics`"
+    await reply_urgently(message, result, parse_mode=ParseMode.MARKDOWN)
+
+
+async def _profile(status: Message, seconds: float):
+    try:
+        stats, file = await profiler.run(seconds)
+    except Exception as err:
+        LOGGER.error(f"Profiling failed: {err}")
+        return await edit_urgently(status, f"分析失败: {err}")
+
+    rows = "\n".join(
+        f"{cumulative:8.3f} {own:8.3f} {calls:>8} {function}"
+        for cumulative, own, calls, function in top_functions(stats, PROFILE_TOP)
+    )
+    await edit_urgently(
+        status,
+        f"**{seconds:g} 秒内累计耗时最多的函数**\n"
+        f"```\n{'累计':>6} {'自身':>6} {'调用':>6} 函数\n{rows}\n```\n"
+        f"完整结果: `{file}` (可用 `python -m pstats` 或 snakeviz 查看)",
+        parse_mode=ParseMode.MARKDOWN,
+    )
+
+
+@app.on_message(filters.command("profile") & filters.user(OWNER_ID))
+async def profile(client, message: Message):
+    """
+    用 cProfile 分析运行中的进程，期间转发会略微变慢
+    用法: /profile [秒数]
+    """
+    args = message.text.split()[1:]
+    try:
+        seconds = float(args[0]) if args else PROFILE_SECONDS
+    except ValueError:
+        return await reply_urgently(
+            message, "**用法:** `/profile [秒数]`", parse_mode=ParseMode.MARKDOWN
+        )
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return await reply_urgently(message, f"秒数需在 0 到 {PROFILE_MAX_SECONDS} 之间")
+    if profiler.running:
+        return await reply_urgently(message, "已有分析在进行，请等待完成")
+
+    note = "，只包括 0 号进程" if SHARDED else ""
+    status = await reply_urgently(message, f"正在分析 {seconds:g} 秒{note}...")
+    # 不占用处理更新的 worker，分析期间的消息照常处理
+    asyncio.create_task(_profile(status, seconds))
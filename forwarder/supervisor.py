@@ -0,0 +1,226 @@
+"""Multi-process mode: run one worker process per shard of the source chats.
+
+Every worker is a normal forwarder started with FORWARDER_SHARD set, logged
+in with its own session. It only handles the sources assigned to it by
+`shard_of`. The supervisor starts the workers one after another so logins
+can be typed in, restarts workers that exit and serves the metrics of all
+workers on HTTP_PORT. The workers write their logs to the same terminal,
+prefixed with their shard. /healthz and /readyz are only OK when they are
+OK for every worker.
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from forwarder import HTTP_HOST, HTTP_PORT, LOGGER, WORKERS, shard_data_dir
+
+# 工作进程退出后的重启间隔: RESTART_BASE_DELAY * 2^(n-1)，最多 RESTART_MAX_DELAY 秒
+RESTART_BASE_DELAY = 1
+RESTART_MAX_DELAY = 60
+# 运行超过这么多秒后退出的不计入连续失败
+STABLE_AFTER = 60
+# 停止时等待工作进程退出的秒数
+STOP_TIMEOUT = 30
+
+
+class Worker:
+    __slots__ = ("shard", "process", "started", "failures", "restart_at", "restarts")
+
+    def __init__(self, shard: int):
+        self.shard = shard
+        self.process: Optional[subprocess.Popen] = None
+        self.started = 0.0
+        self.failures = 0
+        self.restart_at: Optional[float] = None
+        self.restarts = 0
+
+    @property
+    def ready_file(self) -> str:
+        return os.path.join(shard_data_dir(self.shard), "ready")
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        if os.path.exists(self.ready_file):
+            os.remove(self.ready_file)
+        env = dict(os.environ, FORWARDER_SHARD=str(self.shard))
+        self.process = subprocess.Popen([sys.executable, "-m", "forwarder"], env=env)
+        self.started = time.monotonic()
+        self.restart_at = None
+        LOGGER.info(f"Started worker {self.shard} (pid {self.process.pid})")
+
+    def wait_ready(self, stopping: threading.Event):
+        """Wait until the worker has logged in, or exited"""
+        while not stopping.is_set() and self.running and not os.path.exists(self.ready_file):
+            time.sleep(0.5)
+
+    def check(self):
+        """Restart the worker with a backoff after it exited"""
+        if self.running:
+            return
+        now = time.monotonic()
+        if self.restart_at is None:
+            code = self.process.returncode
+            if now - self.started > STABLE_AFTER:
+                self.failures = 0
+            self.failures += 1
+            delay = min(RESTART_MAX_DELAY, RESTART_BASE_DELAY * 2 ** (self.failures - 1))
+            LOGGER.error(f"Worker {self.shard} exited with code {code}, restarting in {delay}s")
+            self.restart_at = now + delay
+        elif now >= self.restart_at:
+            self.restarts += 1
+            self.start()
+
+    def stop(self):
+        if self.running:
+            self.process.send_signal(signal.SIGTERM)
+
+
+def merge_metrics(texts: Dict[int, str]) -> str:
+    """Combine the /metrics output of the workers, adding a shard label to every sample"""
+    families: Dict[str, List[str]] = {}
+    for shard, text in texts.items():
+        family = ""
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(maxsplit=3)
+                family = parts[2] if len(parts) > 2 else family
+                lines = families.setdefault(family, [])
+                if line not in lines:
+                    lines.append(line)
+                continue
+            name, _, value = line.rpartition(" ")
+            label = f'shard="{shard}"'
+            if name.endswith("}"):
+                name = f"{name[:-1]},{label}}}"
+            else:
+                name = f"{name}{{{label}}}"
+            families.setdefault(family, []).append(f"{name} {value}")
+    return "\n".join(line for lines in families.values() for line in lines) + "\n"
+
+
+def _worker_port(shard: int) -> int:
+    # 与 forwarder/__init__.py 中工作进程的端口一致
+    return HTTP_PORT + 1 + shard
+
+
+def _collect(workers: List[Worker]) -> str:
+    texts = {}
+    for worker in workers:
+        url = f"http://127.0.0.1:{_worker_port(worker.shard)}/metrics"
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                texts[worker.shard] = response.read().decode("utf-8")
+        except OSError as err:
+            LOGGER.warning(f"Failed to collect metrics of worker {worker.shard}: {err}")
+
+    own = [
+        "# HELP forwarder_worker_up Whether the worker process is running",
+        "# TYPE forwarder_worker_up gauge",
+    ]
+    own += [f'forwarder_worker_up{{shard="{w.shard}"}} {int(w.running)}' for w in workers]
+    own += [
+        "# HELP forwarder_worker_restarts_total Restarts of the worker process",
+        "# TYPE forwarder_worker_restarts_total counter",
+    ]
+    own += [f'forwarder_worker_restarts_total{{shard="{w.shard}"}} {w.restarts}' for w in workers]
+    return merge_metrics(texts) + "\n".join(own) + "\n"
+
+
+def _check(workers: List[Worker], path: str) -> Tuple[int, dict]:
+    """Combine /healthz or /readyz of the workers"""
+    result = {}
+    ok = True
+    for worker in workers:
+        url = f"http://127.0.0.1:{_worker_port(worker.shard)}{path}"
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                result[str(worker.shard)] = json.load(response)
+        except urllib.error.HTTPError as err:
+            result[str(worker.shard)] = json.load(err)
+            ok = False
+        except (OSError, ValueError) as err:
+            result[str(worker.shard)] = {"ok": False, "error": str(err)}
+            ok = False
+    return (200 if ok else 503), {"ok": ok, "workers": result}
+
+
+def _serve_metrics(workers: List[Worker]) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/metrics":
+                status = 200
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+                body = _collect(workers).encode("utf-8")
+            elif path in ("/healthz", "/readyz"):
+                status, data = _check(workers, path)
+                content_type = "application/json; charset=utf-8"
+                body = (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
+            else:
+                self.send_error(404)
+                return
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((HTTP_HOST, HTTP_PORT), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    LOGGER.info(f"Serving metrics and health of all workers on {HTTP_HOST}:{HTTP_PORT}")
+    return server
+
+
+def run():
+    stopping = threading.Event()
+
+    def handle_signal(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    LOGGER.info(f"Starting {WORKERS} worker processes")
+    workers = [Worker(shard) for shard in range(WORKERS)]
+    for worker in workers:
+        if stopping.is_set():
+            break
+        worker.start()
+        worker.wait_ready(stopping)
+
+    server = _serve_metrics(workers) if HTTP_PORT else None
+
+    while not stopping.wait(1):
+        for worker in workers:
+            worker.check()
+
+    LOGGER.info("Stopping workers...")
+    if server is not None:
+        server.shutdown()
+    for worker in workers:
+        worker.stop()
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for worker in workers:
+        if worker.process is None:
+            continue
+        try:
+            worker.process.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            LOGGER.warning(f"Worker {worker.shard} did not stop in time, killing it")
+            worker.process.kill()
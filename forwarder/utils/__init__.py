@@ -1,2 +1,19 @@
+from .album import *
+from .backfill import *
 from .chat import *
+from .checkpoint import *
+from .dedup import *
 from .message import *
+from .httpd import *
+from .lifecycle import *
+from .mapping import *
+from .metrics import *
+from .peers import *
+from .predicate import *
+from .profiler import *
+from .sender import *
+from .senders import *
+from .store import *
+from .transfer import *
+from .watcher import *
+from .watchdog import *
@@ -0,0 +1,63 @@
+import asyncio
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pyrogram.types import Message
+
+# Telegram 一个相册最多 10 项
+MAX_ALBUM_SIZE = 10
+
+
+class AlbumBuffer:
+    """Collect the parts of a media group that arrive as separate updates.
+
+    The parts of one album are handed to `callback` together, sorted by id,
+    once no new part arrived for `delay` seconds or the album is full, along
+    with the `time.monotonic()` its first part arrived at.
+    """
+
+    def __init__(self, delay: float, callback: Callable[[List[Message], float], None]):
+        self._delay = delay
+        self._callback = callback
+        self._pending: Dict[Tuple[int, str], List[Message]] = {}
+        self._received: Dict[Tuple[int, str], float] = {}
+        self._timers: Dict[Tuple[int, str], asyncio.TimerHandle] = {}
+
+    def add(self, message: Message):
+        key = (message.chat.id, message.media_group_id)
+        self._received.setdefault(key, time.monotonic())
+        parts = self._pending.setdefault(key, [])
+        parts.append(message)
+
+        if len(parts) >= MAX_ALBUM_SIZE:
+            self._flush(key)
+            return
+
+        self._cancel_timer(key)
+        self._timers[key] = asyncio.get_running_loop().call_later(self._delay, self._flush, key)
+
+    def oldest(self, chat_id: int) -> Optional[int]:
+        """Smallest message id of the albums still being collected in a chat"""
+        ids = [
+            message.id
+            for (chat, _), parts in self._pending.items()
+            if chat == chat_id
+            for message in parts
+        ]
+        return min(ids, default=None)
+
+    def flush_all(self):
+        for key in list(self._pending):
+            self._flush(key)
+
+    def _cancel_timer(self, key: Tuple[int, str]):
+        timer: Optional[asyncio.TimerHandle] = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+
+    def _flush(self, key: Tuple[int, str]):
+        self._cancel_timer(key)
+        parts = self._pending.pop(key)
+        received = self._received.pop(key)
+        parts.sort(key=lambda message: message.id)
+        self._callback(parts, received)
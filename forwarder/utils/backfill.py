@@ -0,0 +1,406 @@
+import asyncio
+import json
+import time
+from datetime import date, datetime
+from os import path
+from typing import List, Optional, Tuple
+
+from pyrogram.errors import FloodWait
+from pyrogram.types import Message
+
+from forwarder import DATA_DIR, LOGGER, REMOVE_TAG, app
+from forwarder.utils.chat import ChatConfig, ForwardConfig, SourceRoute, parse_config
+from forwarder.utils.lifecycle import on_shutdown, on_startup
+from forwarder.utils.message import get_topic_id
+from forwarder.utils.sender import (
+    LOWEST_PRIORITY,
+    MAX_FORWARD_BATCH,
+    record_sent,
+    scheduler,
+    send_message,
+)
+from forwarder.utils.senders import senders
+from forwarder.utils.store import write_atomic
+
+# get_messages 一次最多 200 个 id
+PAGE_SIZE = 200
+# 一个相册最多 10 项
+MAX_ALBUM_SIZE = 10
+# 实时转发队列不为空时，每隔几秒再检查
+YIELD_DELAY = 1
+# 进度消息的最短更新间隔 (秒)
+PROGRESS_INTERVAL = 10
+
+BACKFILL_FILE = path.join(DATA_DIR, "backfill.json")
+
+RUNNING = "running"
+PAUSED = "paused"
+DONE = "done"
+CANCELLED = "cancelled"
+
+_STATE_NAMES = {RUNNING: "进行中", PAUSED: "已暂停", DONE: "已完成", CANCELLED: "已取消"}
+
+# (要一起发送的消息 id, 是否为相册)
+Batch = Tuple[List[int], bool]
+
+
+class BackfillJob:
+    """Copy the history of a rule's source to its destinations, oldest first.
+
+    Messages are read by id in pages, filtered with the rule and forwarded in
+    batches. The job only sends while the live queue is empty and takes the
+    account's send budget at the lowest priority, after every rule and owner
+    command reply. Progress is saved each time a batch reaches a destination,
+    so a job interrupted by a restart continues where it stopped without
+    sending anything twice.
+    """
+
+    def __init__(
+        self,
+        rule: dict,
+        number: int,
+        cursor: int,
+        end_id: Optional[int] = None,
+        end_date: Optional[str] = None,
+        state: str = RUNNING,
+        forwarded: int = 0,
+        failed: int = 0,
+        status_chat: Optional[int] = None,
+        status_message: Optional[int] = None,
+        partial: Optional[int] = None,
+        delivered: Optional[List[List[Optional[int]]]] = None,
+        start: Optional[int] = None,
+    ):
+        self.rule = rule
+        self.number = number
+        # 已处理到的消息 id
+        self.cursor = cursor
+        # 开始时的 cursor，用于计算进度百分比
+        self.start_cursor = cursor if start is None else start
+        # cursor 之后正在发送的批次的第一条 id，以及已经发到的 [目标, 话题]，重启后不再重复发送
+        self.partial = partial
+        self.delivered = delivered or []
+        self.end_id = end_id
+        self.end_date = end_date
+        self.state = state
+        self.forwarded = forwarded
+        self.failed = failed
+        self.status_chat = status_chat
+        self.status_message = status_message
+
+        self._config: ForwardConfig = parse_config([rule])[0]
+        self._route = SourceRoute([self._config])
+        self._resumed = asyncio.Event()
+        if state == RUNNING:
+            self._resumed.set()
+        self._task: Optional[asyncio.Task] = None
+        self._reported = 0.0
+
+    @property
+    def source(self) -> int:
+        return self._config.source.get_id()
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (DONE, CANCELLED)
+
+    def to_dict(self) -> dict:
+        return {
+            "rule": self.rule,
+            "number": self.number,
+            "cursor": self.cursor,
+            "end_id": self.end_id,
+            "end_date": self.end_date,
+            "state": self.state,
+            "forwarded": self.forwarded,
+            "failed": self.failed,
+            "status_chat": self.status_chat,
+            "status_message": self.status_message,
+            "partial": self.partial,
+            "delivered": self.delivered,
+            "start": self.start_cursor,
+        }
+
+    def describe(self) -> str:
+        end = self.end_id if self.end_id is not None else "?"
+        text = f"**补发规则 #{self.number}** ({_STATE_NAMES[self.state]})\n"
+        text += f"源: `{self._config.source}`\n"
+        text += f"进度: `{self.cursor}` / `{end}`"
+        if self.end_id:
+            done = self.cursor - self.start_cursor
+            total = max(self.end_id - self.start_cursor, 1)
+            text += f" ({min(100, done * 100 // total)}%)"
+        if self.end_date:
+            text += f"，截止 {self.end_date}"
+        text += f"\n已转发: {self.forwarded} 条"
+        if self.failed:
+            text += f"，失败: {self.failed} 条"
+        return text
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def pause(self):
+        self.state = PAUSED
+        self._resumed.clear()
+
+    def resume(self):
+        self.state = RUNNING
+        self._resumed.set()
+        # 出错停止后重新开始
+        if self._task is None or self._task.done():
+            self.start()
+
+    async def cancel(self):
+        self.state = CANCELLED
+        await self.stop()
+        await self._save()
+
+    async def stop(self):
+        """Stop the task, the saved state is kept for the next start"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _save(self):
+        data = json.dumps(self.to_dict(), ensure_ascii=False)
+        try:
+            await asyncio.to_thread(write_atomic, BACKFILL_FILE, data)
+        except OSError as err:
+            LOGGER.error(f"Failed to save backfill progress: {err}")
+
+    async def report(self, force: bool = False):
+        """Update the progress message"""
+        if self.status_message is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._reported < PROGRESS_INTERVAL:
+            return
+        self._reported = now
+        try:
+            await app.edit_message_text(self.status_chat, self.status_message, self.describe())
+        except Exception as err:
+            LOGGER.debug("Failed to update backfill progress: %s", err)
+
+    async def _run(self):
+        try:
+            if self.end_id is None:
+                async for message in app.get_chat_history(self.source, limit=1):
+                    self.end_id = message.id
+                self.end_id = self.end_id or 0
+                await self._save()
+            LOGGER.info(f"Backfilling rule #{self.number} from {self.cursor + 1} to {self.end_id}")
+
+            while self.cursor < self.end_id:
+                await self._resumed.wait()
+                if not await self._page():
+                    break
+
+            self.state = DONE
+            await self._save()
+            await self.report(force=True)
+            LOGGER.info(f"Backfill of rule #{self.number} finished, {self.forwarded} forwarded")
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            LOGGER.error(f"Backfill of rule #{self.number} stopped: {err}")
+            self.pause()
+            await self._save()
+            await self.report(force=True)
+
+    async def _page(self) -> bool:
+        """Process the next page, returns False once the end date is passed"""
+        last = min(self.end_id, self.cursor + PAGE_SIZE)
+        ids = list(range(self.cursor + 1, last + 1))
+        messages: List[Message] = await app.get_messages(self.source, ids)
+
+        # 相册跨页时留到下一页一起发送，整页都是这个相册时往后读到相册结束
+        if last < self.end_id and messages and messages[-1].media_group_id:
+            group = messages[-1].media_group_id
+            start = len(messages) - 1
+            while start > 0 and messages[start - 1].media_group_id == group:
+                start -= 1
+            if start > 0:
+                messages = messages[:start]
+                last = messages[-1].id
+            else:
+                last = await self._read_album(messages, group, last)
+
+        passed_end = False
+        if self.end_date:
+            end = date.fromisoformat(self.end_date)
+            kept = [m for m in messages if m.empty or m.date.date() <= end]
+            passed_end = len(kept) < len(messages)
+            messages = kept
+
+        for ids, album in self._batches(messages):
+            if self.partial != ids[0]:
+                self.partial, self.delivered = ids[0], []
+            for chat in self._config.destination:
+                target = [chat.get_id(), chat.get_topic()]
+                if target in self.delivered:
+                    continue
+                await self._send(ids, chat, album)
+                self.delivered.append(target)
+                await self._save()
+            self.cursor = ids[-1]
+            self.partial, self.delivered = None, []
+            await self._save()
+            await self.report()
+            await self._resumed.wait()
+
+        self.cursor = last
+        await self._save()
+        return not passed_end
+
+    async def _read_album(self, messages: List[Message], group: str, last: int) -> int:
+        """Append the rest of an album after `last` to the page, returns its last id"""
+        while last < self.end_id:
+            ids = list(range(last + 1, min(self.end_id, last + MAX_ALBUM_SIZE) + 1))
+            for message in await app.get_messages(self.source, ids):
+                if message.media_group_id != group:
+                    return last
+                messages.append(message)
+                last = message.id
+        return last
+
+    def _batches(self, messages: List[Message]) -> List[Batch]:
+        """The messages that pass the rule, grouped into API calls"""
+        topic = self._config.source.get_topic()
+        wanted = [
+            m
+            for m in messages
+            if not m.empty and not m.service and (topic is None or get_topic_id(m) == topic)
+        ]
+
+        batches: List[Batch] = []
+        single: List[int] = []
+        index = 0
+        while index < len(wanted):
+            message = wanted[index]
+            if message.media_group_id:
+                album = [message]
+                while (
+                    index + 1 < len(wanted)
+                    and wanted[index + 1].media_group_id == message.media_group_id
+                ):
+                    index += 1
+                    album.append(wanted[index])
+                captions = "\n".join(m.caption for m in album if m.caption)
+                if self._route.match(captions, album):
+                    if single:
+                        batches.append((single, False))
+                        single = []
+                    batches.append(([m.id for m in album], True))
+            elif self._route.match(message.text or message.caption or "", [message]):
+                single.append(message.id)
+                # 去掉转发标签时只能逐条复制
+                if REMOVE_TAG or len(single) >= MAX_FORWARD_BATCH:
+                    batches.append((single, False))
+                    single = []
+            index += 1
+        if single:
+            batches.append((single, False))
+        return batches
+
+    async def _send(self, ids: List[int], chat: ChatConfig, album: bool):
+        chat_id = chat.get_id()
+        bucket = scheduler.bucket(chat_id)
+        while True:
+            # 实时转发优先
+            if scheduler.pending():
+                await asyncio.sleep(YIELD_DELAY)
+                continue
+            sender, wait = senders.pick(chat_id, self.source)
+            if sender is None or bucket.delay() > 0:
+                await asyncio.sleep(max(wait, bucket.delay()))
+                continue
+
+            # 和实时转发一样按优先级分配账号额度，排在所有规则之后
+            await scheduler.acquire(sender, LOWEST_PRIORITY)
+            if bucket.delay() > 0:
+                continue
+            bucket.consume()
+            try:
+                sent = await send_message(
+                    self.source, ids, chat_id, chat.get_topic(), album=album, client=sender.client
+                )
+            except FloodWait as err:
+                if not senders.rate_limited(sender, chat_id, self.source, err.value + 0.2):
+                    LOGGER.warning(f"Backfill rate limited on {chat_id} for {err.value} seconds")
+                    bucket.penalize(err.value + 0.2)
+                continue
+            except Exception as err:
+                LOGGER.error(f"Backfill failed to forward {ids[0]}..{ids[-1]} to {chat}: {err}")
+                self.failed += len(ids)
+                return
+
+            bucket.reward()
+            sender.bucket.reward()
+            record_sent(self.source, ids, chat_id, sent, sender)
+            self.forwarded += len(ids)
+            return
+
+
+class Backfill:
+    """The backfill job, at most one at a time"""
+
+    def __init__(self):
+        self.job: Optional[BackfillJob] = None
+
+    @property
+    def active(self) -> bool:
+        return self.job is not None and not self.job.finished
+
+    async def start(
+        self,
+        rule: dict,
+        number: int,
+        first_id: int,
+        end_id: Optional[int],
+        end_date: Optional[datetime],
+        status: Message,
+    ) -> BackfillJob:
+        self.job = BackfillJob(
+            rule,
+            number,
+            cursor=max(0, first_id - 1),
+            end_id=end_id,
+            end_date=end_date.date().isoformat() if end_date else None,
+            status_chat=status.chat.id,
+            status_message=status.id,
+        )
+        await self.job._save()
+        self.job.start()
+        return self.job
+
+    def load(self):
+        """Continue the job that was running or paused when the bot stopped"""
+        if not path.isfile(BACKFILL_FILE):
+            return
+        try:
+            with open(BACKFILL_FILE, "r") as data:
+                job = BackfillJob(**json.load(data))
+        except (OSError, ValueError, TypeError) as err:
+            LOGGER.error(f"Ignoring unreadable {BACKFILL_FILE}: {err}")
+            return
+        if job.finished:
+            return
+        self.job = job
+        job.start()
+        LOGGER.info(f"Resuming backfill of rule #{job.number} after message {job.cursor}")
+
+
+backfill = Backfill()
+
+
+@on_startup
+async def resume_backfill():
+    backfill.load()
+
+
+@on_shutdown
+async def stop_backfill():
+    if backfill.job is not None:
+        await backfill.job.stop()
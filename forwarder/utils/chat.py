@@ -1,48 +1,115 @@
-from typing import List, List, Union, Optional
+import json
+from types import MappingProxyType
+from typing import Dict, FrozenSet, List, Mapping, Optional, Sequence, Tuple, Union
 
-from forwarder import CONFIG
+from pyrogram.types import Message
 
+from forwarder import BATCH_SIZE, BATCH_WINDOW, CONFIG, SHARD, SHARDED, WORKERS
+from forwarder.utils.message import KeywordMatcher
+from forwarder.utils.predicate import TEXT_COST, Predicate, compile_predicate, split_predicate
 
-PARSED_CONFIG = []
+RouteKey = Tuple[int, Optional[int]]
+
+PARSED_CONFIG: List["ForwardConfig"] = []
+# (source_id, topic_id) -> SourceRoute，只读，reload_config 时整体替换
+_ROUTES: Mapping[RouteKey, "SourceRoute"] = MappingProxyType({})
+_SOURCES: FrozenSet[int] = frozenset()
+# 规则原文 (json) -> 已解析的规则，用于重新加载时只重建有变化的部分
+_PARSED_BY_KEY: Dict[str, "ForwardConfig"] = {}
+
+_NO_ROUTE: Tuple["ForwardConfig", ...] = ()
+
+# 规则优先级，数字小的先发送，low 只使用剩余的发送额度
+PRIORITIES = {"high": 1, "normal": 2, "low": 3}
+DEFAULT_PRIORITY = PRIORITIES["normal"]
+
+# 积压超出上限时的处理方式，sample 需要写成 sample:N
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "media_only", "sample")
+# (处理方式, sample:N 中的 N)
+Overflow = Tuple[str, int]
+DEFAULT_OVERFLOW: Overflow = ("drop_oldest", 0)
+
+
+def parse_overflow(value: str) -> Overflow:
+    """Parse an overflow policy: drop_oldest, drop_newest, media_only or sample:N
+
+    Raises:
+        ValueError: when the policy is unknown
+    """
+    if not isinstance(value, str):
+        raise ValueError(f"overflow must be a string, got {value!r}")
+    policy, _, every = value.partition(":")
+    if policy == "sample":
+        if not every.isdigit() or int(every) < 1:
+            raise ValueError(f"sample needs a positive N like sample:10, got {value!r}")
+        return policy, int(every)
+    if policy not in OVERFLOW_POLICIES or every:
+        raise ValueError(
+            f"overflow must be drop_oldest, drop_newest, media_only or sample:N, got {value!r}"
+        )
+    return policy, 0
 
 
 class ChatConfig:
-    __chat: Union[str, int]
+    """A chat reference in the form of `chat_id` or `"chat_id#topic_id"`, parsed once."""
+
+    __slots__ = ("_chat", "_id", "_topic")
 
     def __init__(self, chat_id: Union[str, int]):
-        self.__chat = chat_id
+        self._chat = chat_id
+        if isinstance(chat_id, int):
+            self._id = chat_id
+            self._topic = None
+            return
+
+        parts = chat_id.split("#")
+        self._id = int(parts[0])
+        self._topic = int(parts[1]) if len(parts) == 2 else None
 
     def __repr__(self) -> str:
         if self.is_topic:
-            return f"{self.get_id()}#{self.get_topic()}"
-        return str(self.get_id())
+            return f"{self._id}#{self._topic}"
+        return str(self._id)
 
     @property
     def is_topic(self) -> bool:
-        if isinstance(self.__chat, str) and len(self.__chat.split("#")) == 2:
-            return True
-        return False
+        return self._topic is not None
 
     def get_topic(self) -> Optional[int]:
-        if not self.is_topic:
-            return None
-
-        if isinstance(self.__chat, int):
-            return None
-
-        return int(self.__chat.split("#")[1])
+        return self._topic
 
     def get_id(self) -> int:
-        if isinstance(self.__chat, int):
-            return self.__chat
-        return int(self.__chat.split("#")[0])
+        return self._id
 
 
 class ForwardConfig:
+    __slots__ = (
+        "source",
+        "destination",
+        "filters",
+        "blacklist",
+        "batch_window",
+        "batch_size",
+        "name",
+        "label",
+        "when",
+        "priority",
+        "max_backlog",
+        "overflow",
+    )
+
     source: ChatConfig
-    destination: List[ChatConfig]
+    destination: Tuple[ChatConfig, ...]
     filters: Optional[List[str]]
     blacklist: Optional[List[str]]
+    batch_window: float  # 秒
+    batch_size: int
+    name: Optional[str]
+    label: str  # 日志和统计中使用: name 或 "#规则编号"
+    when: Optional[Predicate]
+    priority: int
+    max_backlog: int  # 0 为不限
+    overflow: Overflow
 
     def __init__(
         self,
@@ -50,56 +117,217 @@ class ForwardConfig:
         destination: List[Union[str, int]],
         filters: Optional[List[str]] = None,
         blacklist: Optional[List[str]] = None,
+        batch_window: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        name: Optional[str] = None,
+        when: Optional[dict] = None,
+        priority: Optional[str] = None,
+        max_backlog: Optional[int] = None,
+        overflow: Optional[str] = None,
     ):
         self.source = ChatConfig(source)
-        self.destination = [ChatConfig(item) for item in destination]
+        self.destination = tuple(ChatConfig(item) for item in destination)
         self.filters = filters
         self.blacklist = blacklist
+        # 配置里以毫秒为单位
+        self.batch_window = (BATCH_WINDOW if batch_window is None else batch_window) / 1000
+        self.batch_size = BATCH_SIZE if batch_size is None else batch_size
+        self.name = name
+        self.label = name or str(self.source)
+        # 加载时编译一次
+        self.when = compile_predicate(when) if when is not None else None
+        if priority is not None and priority not in PRIORITIES:
+            raise ValueError(f"priority must be one of {list(PRIORITIES)}, got {priority!r}")
+        self.priority = PRIORITIES[priority] if priority is not None else DEFAULT_PRIORITY
+        if max_backlog is not None and (not isinstance(max_backlog, int) or max_backlog < 0):
+            raise ValueError(f"max_backlog must be a non-negative integer, got {max_backlog!r}")
+        self.max_backlog = max_backlog or 0
+        self.overflow = parse_overflow(overflow) if overflow is not None else DEFAULT_OVERFLOW
 
 
-def get_config() -> List[ForwardConfig]:
-    global PARSED_CONFIG
-    if PARSED_CONFIG:
-        return PARSED_CONFIG
-
-    PARSED_CONFIG = [
-        ForwardConfig(
-            source=chat["source"],
-            destination=chat["destination"],
-            filters=chat.get("filters"),
-            blacklist=chat.get("blacklist"),
+class SourceRoute:
+    """All rules of one source chat/topic, with their keywords compiled into one matcher."""
+
+    __slots__ = ("rules", "_matcher", "_checks")
+
+    rules: Tuple[ForwardConfig, ...]
+
+    def __init__(self, rules: List[ForwardConfig]):
+        self.rules = tuple(rules)
+
+        words: Dict[str, int] = {}
+
+        def word_ids(items: Optional[List[str]]) -> Optional[FrozenSet[int]]:
+            if not items:
+                return None
+            return frozenset(words.setdefault(word, len(words)) for word in items)
+
+        # (规则, 白名单, 黑名单, 在关键词前判断的条件, 在关键词后判断的条件)
+        self._checks = tuple(
+            (
+                rule,
+                word_ids(rule.filters),
+                word_ids(rule.blacklist),
+                *split_predicate(rule.when, TEXT_COST),
+            )
+            for rule in self.rules
         )
-        for chat in CONFIG
-    ]
+        self._matcher = KeywordMatcher(list(words)) if words else None
+
+    def match(self, text: str, messages: Sequence[Message]) -> List[ForwardConfig]:
+        """Return the rules whose whitelist, blacklist and `when` condition allow the message
+
+        `messages` is the message, or all messages of an album, and `text` its
+        text or the joined captions. The keywords of all rules are found in one
+        scan, which only runs if a rule gets that far.
+        """
+        found = None
+        matched = []
+        for rule, allow, deny, before, after in self._checks:
+            if before is not None and not before.test(messages, text):
+                continue
+            if allow is not None or deny is not None:
+                if found is None:
+                    found = self._matcher.search(text)
+                if allow is not None and allow.isdisjoint(found):
+                    continue
+                if deny is not None and not deny.isdisjoint(found):
+                    continue
+            if after is not None and not after.test(messages, text):
+                continue
+            matched.append(rule)
+        return matched
+
+
+def shard_of(chat_id: int, shards: int = WORKERS) -> int:
+    """The worker process that handles a source chat in multi-process mode"""
+    return abs(chat_id) % shards
+
+
+def _build_routes(configs: List[ForwardConfig]) -> Mapping[RouteKey, SourceRoute]:
+    grouped: Dict[RouteKey, List[ForwardConfig]] = {}
+    for config in configs:
+        # 多进程模式下只处理分给本进程的源
+        if SHARDED and shard_of(config.source.get_id()) != SHARD:
+            continue
+        key = (config.source.get_id(), config.source.get_topic())
+        grouped.setdefault(key, []).append(config)
+
+    routes = {}
+    for key, rules in grouped.items():
+        # 规则没有变化的源直接沿用已编译的匹配器
+        current = _ROUTES.get(key)
+        if current is not None and current.rules == tuple(rules):
+            routes[key] = current
+        else:
+            routes[key] = SourceRoute(rules)
+    return MappingProxyType(routes)
+
+
+def get_config() -> List[ForwardConfig]:
     return PARSED_CONFIG
 
 
+def parse_config(raw: list) -> List[ForwardConfig]:
+    """Parse the rules of chat_list.json
+
+    Raises:
+        ValueError: when the file is not an array or a rule is invalid
+    """
+    if not isinstance(raw, list):
+        raise ValueError("the config must be an array of rules")
+
+    parsed = []
+    for number, chat in enumerate(raw, 1):
+        try:
+            cached = _PARSED_BY_KEY.get(_rule_key(chat))
+            if cached is not None:
+                parsed.append(cached)
+                continue
+
+            if not isinstance(chat["destination"], list):
+                raise TypeError("destination must be an array")
+            parsed.append(
+                ForwardConfig(
+                    source=chat["source"],
+                    destination=chat["destination"],
+                    filters=chat.get("filters"),
+                    blacklist=chat.get("blacklist"),
+                    batch_window=chat.get("batch_window"),
+                    batch_size=chat.get("batch_size"),
+                    name=chat.get("name"),
+                    when=chat.get("when"),
+                    priority=chat.get("priority"),
+                    max_backlog=chat.get("max_backlog"),
+                    overflow=chat.get("overflow"),
+                )
+            )
+        except (AttributeError, KeyError, TypeError, ValueError) as err:
+            raise ValueError(f"invalid rule #{number}: {err!r}") from err
+    return parsed
+
+
+def _rule_key(chat: dict) -> str:
+    return json.dumps(chat, sort_keys=True, ensure_ascii=False)
+
+
+def _install(raw: list, parsed: List[ForwardConfig]):
+    global PARSED_CONFIG, _ROUTES, _SOURCES, _PARSED_BY_KEY
+    routes = _build_routes(parsed)
+    sources = frozenset(source for source, _ in routes)
+    by_key = {_rule_key(chat): config for chat, config in zip(raw, parsed)}
+    for number, config in enumerate(parsed, 1):
+        config.label = config.name or f"#{number}"
+
+    # 几次赋值之间没有 await，事件循环上不会看到新旧混合的状态
+    PARSED_CONFIG = parsed
+    _ROUTES = routes
+    _SOURCES = sources
+    _PARSED_BY_KEY = by_key
+
+
 def reload_config():
-    """重新加载配置（当配置被修改后调用）"""
-    global PARSED_CONFIG
-    PARSED_CONFIG = [
-        ForwardConfig(
-            source=chat["source"],
-            destination=chat["destination"],
-            filters=chat.get("filters"),
-            blacklist=chat.get("blacklist"),
-        )
-        for chat in CONFIG
-    ]
+    """重新加载配置（当配置被修改后调用），只重建有变化的规则和源"""
+    _install(CONFIG, parse_config(CONFIG))
+    return PARSED_CONFIG
+
+
+def apply_config(raw: list) -> List[ForwardConfig]:
+    """Replace all rules with new ones, the current rules stay in place if they are invalid
+
+    Raises:
+        ValueError: when the new rules are invalid
+    """
+    parsed = parse_config(raw)
+    CONFIG[:] = raw
+    _install(raw, parsed)
     return PARSED_CONFIG
 
 
-def get_destination(chat_id: int, topic_id: Optional[int] = None) -> List[ForwardConfig]:
+def is_source(chat_id: int) -> bool:
+    """Whether any rule listens to this chat"""
+    return chat_id in _SOURCES
+
+
+def get_sources() -> FrozenSet[int]:
+    """All source chats that rules listen to"""
+    return _SOURCES
+
+
+def get_destination(chat_id: int, topic_id: Optional[int] = None) -> Tuple[ForwardConfig, ...]:
     """Get destination from a specific source chat
 
     Args:
         chat_id (`int`): source chat id
         topic_id (`Optional[int]`): source topic id. Defaults to None.
     """
+    route = _ROUTES.get((chat_id, topic_id))
+    return route.rules if route else _NO_ROUTE
+
+
+def get_route(chat_id: int, topic_id: Optional[int] = None) -> Optional[SourceRoute]:
+    """Get the compiled route of a source chat, None if nothing listens to it"""
+    return _ROUTES.get((chat_id, topic_id))
 
-    dest: List[ForwardConfig] = []
 
-    for chat in get_config():
-        if chat.source.get_id() == chat_id and chat.source.get_topic() == topic_id:
-            dest.append(chat)
-    return dest
+reload_config()
@@ -0,0 +1,142 @@
+import asyncio
+import sqlite3
+from os import path
+from typing import Dict, Optional, Set, Tuple
+
+from forwarder import DATA_DIR, LOGGER
+from forwarder.utils.lifecycle import on_shutdown, on_startup
+
+# (source, topic)，不是论坛话题时 topic 为 0
+CheckpointKey = Tuple[int, int]
+
+# 进度写入数据库的间隔 (秒)，崩溃时最多重新处理这段时间内的消息
+FLUSH_INTERVAL = 2
+
+_MIGRATIONS = [
+    """
+    CREATE TABLE checkpoints (
+        source INTEGER NOT NULL,
+        topic INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        PRIMARY KEY (source, topic)
+    )
+    """,
+]
+
+
+class CheckpointStore:
+    """The last processed message id per source chat and topic, kept in SQLite.
+
+    A message counts as processed once it was filtered and, if it matched,
+    written to the outbox. Messages of an album that is still being collected
+    hold the checkpoint of their chat back until the album is processed, so a
+    crash never skips them.
+
+    Progress is kept in memory and written every `FLUSH_INTERVAL` seconds in
+    one transaction, not once per message. A crash may process the last few
+    messages again but never skips one.
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self._stored: Dict[CheckpointKey, int] = dict(
+            ((source, topic), message_id)
+            for source, topic, message_id in self._db.execute(
+                "SELECT source, topic, message_id FROM checkpoints"
+            )
+        )
+        # 已处理的最大 id，可能因为未发出的相册而大于已保存的
+        self._latest: Dict[CheckpointKey, int] = dict(self._stored)
+        # 还没写入数据库的进度
+        self._dirty: Set[CheckpointKey] = set()
+        # 源 -> 保存的进度不能超过的 id，补发没读到的消息之前使用
+        self._holds: Dict[int, int] = {}
+
+    def _migrate(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        for statement in _MIGRATIONS[version:]:
+            self._db.execute(statement)
+        self._db.execute(f"PRAGMA user_version = {len(_MIGRATIONS)}")
+
+    def get(self, source: int) -> Optional[int]:
+        """Last processed message of a source chat in any topic, None if never seen"""
+        ids = [message_id for (chat, _), message_id in self._latest.items() if chat == source]
+        return max(ids, default=None)
+
+    def advance(
+        self, source: int, topic: Optional[int], message_id: int, hold: Optional[int] = None
+    ):
+        """Record a processed message, staying below `hold`, the oldest unprocessed id"""
+        key = (source, topic or 0)
+        latest = max(self._latest.get(key, 0), message_id)
+        self._latest[key] = latest
+        self._store(key, latest, hold)
+
+    def hold(self, source: int, message_id: int):
+        """Keep the saved checkpoints of a source at or below `message_id` until released,
+        while older messages are still unread"""
+        self._holds[source] = message_id
+
+    def release(self, source: int, hold: Optional[int] = None):
+        """Let the saved checkpoints of a source move up to its processed messages again"""
+        if self._holds.pop(source, None) is None:
+            return
+        for key, latest in list(self._latest.items()):
+            if key[0] == source:
+                self._store(key, latest, hold)
+
+    def _store(self, key: CheckpointKey, latest: int, hold: Optional[int]):
+        value = latest if hold is None else min(latest, hold - 1)
+        held = self._holds.get(key[0])
+        if held is not None:
+            value = min(value, held)
+        if value <= self._stored.get(key, 0):
+            return
+        self._stored[key] = value
+        self._dirty.add(key)
+
+    def flush(self):
+        """Write the progress recorded since the last flush"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        try:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    "INSERT INTO checkpoints (source, topic, message_id) VALUES (?, ?, ?)"
+                    " ON CONFLICT (source, topic) DO UPDATE SET message_id = excluded.message_id",
+                    [(source, topic, self._stored[(source, topic)]) for source, topic in dirty],
+                )
+        except sqlite3.Error:
+            self._dirty |= dirty
+            raise
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+checkpoints = CheckpointStore(path.join(DATA_DIR, "checkpoints.db"))
+
+
+async def _flush_checkpoints():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            checkpoints.flush()
+        except sqlite3.Error as err:
+            LOGGER.error(f"Failed to save checkpoints: {err}")
+
+
+@on_startup
+async def start_checkpoints():
+    asyncio.create_task(_flush_checkpoints())
+
+
+@on_shutdown
+async def close_checkpoints():
+    checkpoints.close()
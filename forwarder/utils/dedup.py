@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import Iterable, Optional, Tuple
+
+from pyrogram.types import Message
+
+from forwarder import LOGGER
+from forwarder.utils.store import write_atomic
+
+# (目标 chat_id, 目标 topic, 内容指纹)
+DedupKey = Tuple[int, Optional[int], int]
+
+
+def content_fingerprint(messages: Iterable[Message]) -> Optional[int]:
+    """Fingerprint of what a message (or an album) shows: its text, or media plus caption
+
+    Returns None when there is nothing to compare, e.g. a poll or a location.
+    """
+    digest = blake2b(digest_size=8)
+    empty = True
+    for message in messages:
+        media = getattr(message, message.media.value, None) if message.media else None
+        file_id = getattr(media, "file_unique_id", None)
+        text = message.text or message.caption or ""
+        if not file_id and not text:
+            continue
+
+        empty = False
+        digest.update((file_id or "").encode())
+        digest.update(b"\0")
+        # 忽略空白差异
+        digest.update(" ".join(text.split()).encode())
+        digest.update(b"\0")
+
+    if empty:
+        return None
+    return int.from_bytes(digest.digest(), "big")
+
+
+class DedupCache:
+    """Remember what was sent to each destination for `ttl` seconds, at most `max_size` entries.
+
+    Entries expire `ttl` seconds after they were first seen; when the cache is
+    full the least recently seen entry is evicted first.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        # key -> 过期时间 (time.time)，按最近访问排序
+        self._entries: "OrderedDict[DedupKey, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def seen(self, key: DedupKey) -> bool:
+        """True if the key was sent within the TTL"""
+        expires = self._entries.get(key)
+        if expires is not None and expires > time.time():
+            self._entries.move_to_end(key)
+            return True
+        return False
+
+    def add(self, key: DedupKey):
+        """Remember a key as sent"""
+        self._entries[key] = time.time() + self.ttl
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def prune(self):
+        """Drop expired entries"""
+        now = time.time()
+        for key in [key for key, expires in self._entries.items() if expires <= now]:
+            del self._entries[key]
+
+    async def save(self, path: str):
+        """Write a snapshot in a thread, replacing the previous one atomically"""
+        self.prune()
+        data = json.dumps([[*key, expires] for key, expires in self._entries.items()])
+        await asyncio.to_thread(write_atomic, path, data)
+
+    def load(self, path: str):
+        if not os.path.isfile(path):
+            return
+        try:
+            with open(path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as err:
+            LOGGER.warning(f"Ignoring unreadable dedup snapshot {path}: {err}")
+            return
+
+        now = time.time()
+        for chat_id, topic, fingerprint, expires in entries[-self.max_size :]:
+            if expires > now:
+                self._entries[(chat_id, topic, fingerprint)] = expires
+        LOGGER.info(f"Loaded {len(self._entries)} dedup entries from {path}")
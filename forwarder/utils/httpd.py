@@ -0,0 +1,86 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from forwarder import HTTP_HOST, HTTP_PORT, LOGGER
+from forwarder.utils.lifecycle import on_shutdown, on_startup
+from forwarder.utils.metrics import REGISTRY
+
+# 返回 (状态码, Content-Type, 内容)
+Response = Tuple[int, str, str]
+Handler = Callable[[], Awaitable[Response]]
+
+_REASONS = {200: "OK", 404: "Not Found", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HttpServer:
+    """A tiny HTTP/1.0 server for local GET endpoints such as /metrics"""
+
+    def __init__(self):
+        self.routes: Dict[str, Handler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def route(self, path: str):
+        def decorator(func: Handler) -> Handler:
+            self.routes[path] = func
+            return func
+
+        return decorator
+
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        LOGGER.info(f"HTTP endpoints {sorted(self.routes)} listening on {host}:{port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5)
+            parts = request.decode("latin-1").split()
+            path = parts[1].split("?", 1)[0] if len(parts) >= 2 else ""
+
+            handler = self.routes.get(path)
+            if handler is None:
+                status, content_type, body = 404, "text/plain", "not found\n"
+            else:
+                try:
+                    status, content_type, body = await handler()
+                except Exception as err:
+                    LOGGER.error(f"HTTP handler for {path} failed: {err}")
+                    status, content_type, body = 500, "text/plain", "internal error\n"
+
+            payload = body.encode("utf-8")
+            writer.write(
+                f"HTTP/1.0 {status} {_REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1")
+                + payload
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+http_server = HttpServer()
+
+
+@http_server.route("/metrics")
+async def metrics():
+    return 200, "text/plain; version=0.0.4", REGISTRY.render()
+
+
+if HTTP_PORT:
+
+    @on_startup
+    async def start_http_server():
+        await http_server.start(HTTP_HOST, HTTP_PORT)
+
+    @on_shutdown
+    async def stop_http_server():
+        await http_server.stop()
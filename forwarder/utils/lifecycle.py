@@ -0,0 +1,79 @@
+import time
+from typing import Awaitable, Callable, List
+
+from pyrogram.raw.functions.updates import GetState
+
+from forwarder import app, LOGGER
+
+Hook = Callable[[], Awaitable[None]]
+
+# 启动时耗时超过这么多秒的钩子会单独列出
+SLOW_HOOK = 0.1
+
+_STARTUP: List[Hook] = []
+_SHUTDOWN: List[Hook] = []
+_RECONNECT: List[Hook] = []
+
+
+def on_startup(func: Hook) -> Hook:
+    """Run a coroutine function after the client has started"""
+    _STARTUP.append(func)
+    return func
+
+
+def on_shutdown(func: Hook) -> Hook:
+    """Run a coroutine function before the client stops"""
+    _SHUTDOWN.append(func)
+    return func
+
+
+def on_reconnect(func: Hook) -> Hook:
+    """Run a coroutine function after `restart_client` reconnected"""
+    _RECONNECT.append(func)
+    return func
+
+
+_original_start = app.start
+_original_stop = app.stop
+
+
+async def _start(*args, **kwargs):
+    started = time.monotonic()
+    result = await _original_start(*args, **kwargs)
+    timings = [f"login {time.monotonic() - started:.2f}s"]
+    for hook in _STARTUP:
+        hook_started = time.monotonic()
+        try:
+            await hook()
+        except Exception as err:
+            LOGGER.error(f"Startup hook {hook.__qualname__} failed: {err}")
+        elapsed = time.monotonic() - hook_started
+        if elapsed >= SLOW_HOOK:
+            timings.append(f"{hook.__name__} {elapsed:.2f}s")
+    LOGGER.info(f"Started in {time.monotonic() - started:.2f}s ({', '.join(timings)})")
+    return result
+
+
+async def _stop(*args, **kwargs):
+    for hook in reversed(_SHUTDOWN):
+        try:
+            await hook()
+        except Exception as err:
+            LOGGER.error(f"Shutdown hook {hook.__qualname__} failed: {err}")
+    return await _original_stop(*args, **kwargs)
+
+
+app.start = _start
+app.stop = _stop
+
+
+async def restart_client():
+    """Reconnect to Telegram, the handlers and hooks stay in place"""
+    await app.session.restart()
+    # 让服务器重新开始推送更新
+    await app.invoke(GetState())
+    for hook in _RECONNECT:
+        try:
+            await hook()
+        except Exception as err:
+            LOGGER.error(f"Reconnect hook {hook.__qualname__} failed: {err}")
@@ -0,0 +1,162 @@
+import asyncio
+import sqlite3
+import time
+from os import path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from forwarder import DATA_DIR, LOGGER, MESSAGE_MAP_DAYS
+from forwarder.utils.lifecycle import on_shutdown, on_startup
+
+# (目标, 目标中的消息 id, 发送账号, 是否为复制)
+Copy = Tuple[int, int, str, bool]
+
+# 过期记录的清理间隔 (秒)
+PRUNE_INTERVAL = 3600
+
+_MIGRATIONS = [
+    """
+    CREATE TABLE accounts (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    """,
+    # 按 (源, 消息) 查找时只读主键，不需要 rowid
+    """
+    CREATE TABLE messages (
+        source INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        destination INTEGER NOT NULL,
+        dest_message_id INTEGER NOT NULL,
+        account INTEGER NOT NULL,
+        copied INTEGER NOT NULL,
+        sent INTEGER NOT NULL,
+        PRIMARY KEY (source, message_id, destination)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX messages_sent ON messages (sent)",
+]
+
+
+class MessageMap:
+    """Which destination messages each forwarded source message became, kept in SQLite.
+
+    Rows are keyed by (source, message_id, destination) in a table without
+    rowid, so looking up the copies of a message reads a handful of adjacent
+    index pages however many rows there are. Accounts are stored as small
+    integers and rows older than `max_age` seconds are pruned, which keeps the
+    file bounded by the traffic of that period.
+    """
+
+    def __init__(self, path: str, max_age: float):
+        self.max_age = max_age
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self._account_ids: Dict[str, int] = dict(
+            self._db.execute("SELECT name, id FROM accounts")
+        )
+        self._account_names = {value: key for key, value in self._account_ids.items()}
+
+    def _migrate(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        for statement in _MIGRATIONS[version:]:
+            self._db.execute(statement)
+        self._db.execute(f"PRAGMA user_version = {len(_MIGRATIONS)}")
+
+    def _account_id(self, name: str) -> int:
+        account = self._account_ids.get(name)
+        if account is None:
+            account = self._db.execute(
+                "INSERT INTO accounts (name) VALUES (?)", (name,)
+            ).lastrowid
+            self._account_ids[name] = account
+            self._account_names[account] = name
+        return account
+
+    def add(
+        self,
+        source: int,
+        pairs: Iterable[Tuple[int, int]],
+        destination: int,
+        account: str,
+        copied: bool,
+    ):
+        """Record (source message id, destination message id) pairs sent to a destination"""
+        account_id = self._account_id(account)
+        now = int(time.time())
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO messages"
+                " (source, message_id, destination, dest_message_id, account, copied, sent)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (source, message_id, destination, dest_id, account_id, int(copied), now)
+                    for message_id, dest_id in pairs
+                ],
+            )
+
+    def get(self, source: int, message_id: int) -> List[Copy]:
+        """Every copy of a source message"""
+        return [
+            (destination, dest_id, self._account_names[account], bool(copied))
+            for destination, dest_id, account, copied in self._db.execute(
+                "SELECT destination, dest_message_id, account, copied FROM messages"
+                " WHERE source = ? AND message_id = ?",
+                (source, message_id),
+            )
+        ]
+
+    def find(self, source: int, message_id: int, destination: int) -> Optional[int]:
+        """The id of a source message in one destination, None if it wasn't sent there"""
+        row = self._db.execute(
+            "SELECT dest_message_id FROM messages"
+            " WHERE source = ? AND message_id = ? AND destination = ?",
+            (source, message_id, destination),
+        ).fetchone()
+        return row[0] if row else None
+
+    def forget(self, source: int, message_ids: Sequence[int]):
+        self._db.executemany(
+            "DELETE FROM messages WHERE source = ? AND message_id = ?",
+            [(source, message_id) for message_id in message_ids],
+        )
+
+    def prune(self) -> int:
+        """Drop rows older than `max_age`, returns how many"""
+        cutoff = int(time.time() - self.max_age)
+        return self._db.execute("DELETE FROM messages WHERE sent < ?", (cutoff,)).rowcount
+
+    def close(self):
+        self._db.close()
+
+
+message_map = (
+    MessageMap(path.join(DATA_DIR, "messages.db"), MESSAGE_MAP_DAYS * 86400)
+    if MESSAGE_MAP_DAYS > 0
+    else None
+)
+
+
+async def _prune_messages():
+    while True:
+        try:
+            pruned = message_map.prune()
+        except sqlite3.Error as err:
+            LOGGER.error(f"Failed to prune the message map: {err}")
+        else:
+            if pruned:
+                LOGGER.info(f"Forgot {pruned} messages older than {MESSAGE_MAP_DAYS} days")
+        await asyncio.sleep(PRUNE_INTERVAL)
+
+
+if message_map is not None:
+
+    @on_startup
+    async def start_pruning():
+        asyncio.create_task(_prune_messages())
+
+    @on_shutdown
+    async def close_message_map():
+        message_map.close()
@@ -1,6 +1,22 @@
 import re
 
-from typing import List
+from typing import Dict, FrozenSet, List, Optional, Sequence, Set
+
+from pyrogram.types import Message
+
+_WORD_CHAR = re.compile(r"\w")
+
+
+def get_topic_id(message: Message) -> Optional[int]:
+    """获取 topic_id (如果是论坛)"""
+    is_forum = getattr(message.chat, 'is_forum', False)
+    if hasattr(message, 'topic') and message.topic:
+        return message.topic.id
+    elif hasattr(message, 'reply_to_top_message_id') and message.reply_to_top_message_id:
+        return message.reply_to_top_message_id
+    elif hasattr(message, 'reply_to_message_id') and message.reply_to_message_id and is_forum:
+        return message.reply_to_message_id
+    return None
 
 
 def predicate_text(filters: List[str], text: str) -> bool:
@@ -11,3 +27,76 @@ def predicate_text(filters: List[str], text: str) -> bool:
             return True
 
     return False
+
+
+class _CaseFold(dict):
+    """`str.translate` table mapping each character to a key shared by all
+    characters that `re.IGNORECASE` treats as equal, filled on first use"""
+
+    def __missing__(self, code: int) -> str:
+        char = chr(code)
+        upper = char.upper()
+        lower = upper.lower() if len(upper) == 1 else char
+        if len(lower) != 1:
+            lower = lower[0]  # "İ"
+        if len(lower.upper()) != 1:
+            # "ß"、"ﬅ" 等大写为多个字符的，按 casefold 区分
+            lower = "\0" + lower.casefold()
+        self[code] = lower
+        return lower
+
+
+_CASE_FOLD = _CaseFold()
+
+
+def _fold(text: str) -> str:
+    return text.translate(_CASE_FOLD)
+
+
+class KeywordMatcher:
+    """Find which of many keywords occur in a text with a single regex scan.
+
+    Uses the same rules as `predicate_text`: case-insensitive and the keyword
+    must not be surrounded by word characters.
+    """
+
+    __slots__ = ("words", "_pattern", "_indexes", "_lengths")
+
+    def __init__(self, words: Sequence[str]):
+        self.words = tuple(words)
+        # 忽略大小写后的形式 -> 词的下标，只有大小写不同的词共用一项
+        self._indexes: Dict[str, List[int]] = {}
+        for index, word in enumerate(self.words):
+            self._indexes.setdefault(_fold(word), []).append(index)
+        self._lengths = sorted({len(word) for word in self.words})
+
+        # 每个位置只捕获最长的一个词，较短的同前缀词在 search 中按长度补查。
+        # 只用一个捕获组: 每个词一个组时编译和匹配的耗时随词数急剧增长
+        unique = sorted(dict.fromkeys(self.words), key=len, reverse=True)
+        alternatives = "|".join(re.escape(word) for word in unique)
+        # 先用首字符集合快速排除不可能匹配的位置
+        guard = ""
+        if self.words and all(self.words):
+            first_chars = sorted({word[0] for word in self.words})
+            guard = "(?=[" + "".join(re.escape(char) for char in first_chars) + "])"
+
+        self._pattern = re.compile(
+            rf"(?<!\w){guard}(?=({alternatives})(?!\w))", flags=re.IGNORECASE
+        )
+
+    def search(self, text: str) -> FrozenSet[int]:
+        """Return the indexes of all keywords found in the text"""
+        found: Set[int] = set()
+        for match in self._pattern.finditer(text):
+            matched = match.group(1)
+            found.update(self._indexes[_fold(matched)])
+
+            start = match.start()
+            for length in self._lengths:
+                if length >= len(matched):
+                    break
+                end = start + length
+                if _WORD_CHAR.match(text, end) is None:
+                    found.update(self._indexes.get(_fold(text[start:end]), ()))
+
+        return frozenset(found)
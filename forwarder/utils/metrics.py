@@ -0,0 +1,177 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+Labels = Tuple[str, ...]
+
+# 秒
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+FILTER_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    @abstractmethod
+    def samples(self) -> List[Tuple[str, Sequence[str], Sequence[str], float]]:
+        """(suffix, label names, label values, value) of every series"""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {value:g}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def samples(self):
+        return [("", self.labels, key, value) for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    """A value read from a callback when the metrics are collected"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        super().__init__(name, help)
+        self.read = read
+
+    def samples(self):
+        return [("", (), (), self.read())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [每个桶的计数..., +Inf 计数, 总和]
+        self.values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def quantile(self, q: float, *labels: str) -> Optional[float]:
+        """Upper bound of the bucket containing the q-quantile, None without data"""
+        series = self.values.get(labels)
+        if not series:
+            return None
+        count = sum(series[:-1])
+        seen = 0
+        for bound, hits in zip(self.buckets + (float("inf"),), series[:-1]):
+            seen += hits
+            if seen >= q * count:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        result = []
+        names = self.labels + ("le",)
+        for key, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, hits in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += hits
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                result.append(("_bucket", names, key + (le,), cumulative))
+            result.append(("_sum", self.labels, key, series[-1]))
+            result.append(("_count", self.labels, key, cumulative))
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+MESSAGES_MATCHED = REGISTRY.register(
+    Counter("forwarder_messages_matched_total", "Messages that passed a rule's filters", ["rule"])
+)
+MESSAGES_FILTERED = REGISTRY.register(
+    Counter("forwarder_messages_filtered_total", "Messages dropped by a rule's filters", ["rule"])
+)
+MESSAGES_SENT = REGISTRY.register(
+    Counter(
+        "forwarder_messages_sent_total", "Messages delivered", ["rule", "destination"]
+    )
+)
+MESSAGES_FAILED = REGISTRY.register(
+    Counter(
+        "forwarder_messages_failed_total",
+        "Failed send attempts, including retried ones",
+        ["rule", "destination"],
+    )
+)
+MESSAGES_SKIPPED = REGISTRY.register(
+    Counter(
+        "forwarder_messages_skipped_total",
+        "Messages dropped because a backlog limit was reached",
+        ["rule", "destination"],
+    )
+)
+FLOODWAIT_SECONDS = REGISTRY.register(
+    Counter("forwarder_floodwait_seconds_total", "Seconds of FloodWait received", ["destination"])
+)
+SEND_LATENCY = REGISTRY.register(
+    Histogram(
+        "forwarder_receive_to_send_seconds",
+        "Time from receiving a message to delivering it",
+        LATENCY_BUCKETS,
+    )
+)
+FILTER_TIME = REGISTRY.register(
+    Histogram(
+        "forwarder_filter_seconds", "Time spent evaluating the filters of a message", FILTER_BUCKETS
+    )
+)
+STAGE_TIME = REGISTRY.register(
+    Histogram(
+        "forwarder_stage_seconds",
+        "Time spent in each stage of handling a message: handler, route, queue and send",
+        STAGE_BUCKETS,
+        ["stage"],
+    )
+)
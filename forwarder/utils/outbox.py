@@ -0,0 +1,110 @@
+import sqlite3
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+# (source, message_id, destination, topic, media_group, reply_to, priority)
+JobRow = Tuple[int, int, int, Optional[int], Optional[str], Optional[int], int]
+
+PENDING = 0
+DEAD = 1
+
+# 按顺序执行，PRAGMA user_version 记录已执行到第几条
+_MIGRATIONS = [
+    """
+    CREATE TABLE jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        destination INTEGER NOT NULL,
+        topic INTEGER,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        status INTEGER NOT NULL DEFAULT 0,
+        error TEXT
+    )
+    """,
+    "CREATE INDEX jobs_status ON jobs (status, id)",
+    # 相册的各项各占一行，发送时按 media_group 合并
+    "ALTER TABLE jobs ADD COLUMN media_group TEXT",
+    # 源消息回复的消息，发送时换成它在目标中的 id
+    "ALTER TABLE jobs ADD COLUMN reply_to INTEGER",
+    # 规则的优先级，重启后恢复的任务也按它排队
+    "ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 2",
+]
+
+
+class Outbox:
+    """Durable queue of outgoing sends, kept in SQLite with write-ahead logging.
+
+    A job is inserted before it is scheduled and deleted once delivered, so
+    whatever is left in the table after a crash is sent again on the next start.
+    Jobs that keep failing are kept with status DEAD for inspection.
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+
+    def _migrate(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        for statement in _MIGRATIONS[version:]:
+            self._db.execute(statement)
+        self._db.execute(f"PRAGMA user_version = {len(_MIGRATIONS)}")
+
+    def put_many(self, rows: Iterable[JobRow]) -> List[int]:
+        """Store new jobs in one transaction and return their ids"""
+        ids = []
+        with self._db:
+            self._db.execute("BEGIN")
+            for row in rows:
+                cursor = self._db.execute(
+                    "INSERT INTO jobs"
+                    " (source, message_id, destination, topic, media_group, reply_to, priority)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    row,
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def pending(
+        self,
+    ) -> List[Tuple[int, int, int, int, Optional[int], Optional[str], Optional[int], int, int]]:
+        """All undelivered jobs in insertion order"""
+        return self._db.execute(
+            "SELECT id, source, message_id, destination, topic, media_group, reply_to, priority,"
+            " attempts FROM jobs WHERE status = ? ORDER BY id",
+            (PENDING,),
+        ).fetchall()
+
+    def _execute_many(self, statement: str, params: List[tuple]):
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(statement, params)
+
+    def ack(self, job_ids: Sequence[int]):
+        self._execute_many("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+
+    def retry(self, job_ids: Sequence[int], attempts: int, error: str):
+        self._execute_many(
+            "UPDATE jobs SET attempts = ?, error = ? WHERE id = ?",
+            [(attempts, error, job_id) for job_id in job_ids],
+        )
+
+    def bury(self, job_ids: Sequence[int], error: str):
+        self._execute_many(
+            "UPDATE jobs SET status = ?, error = ? WHERE id = ?",
+            [(DEAD, error, job_id) for job_id in job_ids],
+        )
+
+    def depth(self) -> int:
+        return self._db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = ?", (PENDING,)
+        ).fetchone()[0]
+
+    def dead(self) -> int:
+        return self._db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = ?", (DEAD,)
+        ).fetchone()[0]
+
+    def close(self):
+        self._db.close()
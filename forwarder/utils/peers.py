@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import json
+import time
+from os import path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from pyrogram import Client, raw
+from pyrogram.utils import get_channel_id
+
+from forwarder import DATA_DIR, LOGGER, PEER_WARMUP_CONCURRENCY
+from forwarder.utils.chat import get_config, get_sources
+from forwarder.utils.store import write_atomic
+
+# chat_id -> (access_hash, pyrogram 存储中的类型)
+Peers = Dict[int, Tuple[int, str]]
+
+
+def config_chats() -> Set[int]:
+    """Every source and destination chat of the rules this process handles"""
+    sources = get_sources()
+    chats = set(sources)
+    for rule in get_config():
+        if rule.source.get_id() in sources:
+            chats.update(chat.get_id() for chat in rule.destination)
+    return chats
+
+
+def config_version(chats: Iterable[int]) -> str:
+    return hashlib.sha1(",".join(map(str, sorted(chats))).encode()).hexdigest()[:16]
+
+
+def _peer_entry(peer) -> Optional[Tuple[int, int, str]]:
+    """(chat_id, access_hash, type) of a resolved input peer"""
+    if isinstance(peer, raw.types.InputPeerChannel):
+        return get_channel_id(peer.channel_id), peer.access_hash, "channel"
+    if isinstance(peer, raw.types.InputPeerUser):
+        return peer.user_id, peer.access_hash, "user"
+    if isinstance(peer, raw.types.InputPeerChat):
+        return -peer.chat_id, 0, "group"
+    return None
+
+
+class PeerCache:
+    """Access hashes of the configured chats, kept next to the session.
+
+    Pyrogram needs the access hash of a chat before it can send there and only
+    learns it from updates, dialogs or an explicit lookup. Warming up resolves
+    all configured chats before the first send, and the cache puts the hashes
+    back into a session that lost them, e.g. a new worker session, without
+    asking Telegram again. Chats found in the file are not looked up again,
+    only those added to the config since it was written or that failed last
+    time. The file also records the config version, to log when it changed.
+    """
+
+    def __init__(self, client: Client, name: str):
+        self.client = client
+        self.name = name
+        self.file = path.join(DATA_DIR, f"peers-{name}.json")
+
+    def _load(self) -> Tuple[Optional[str], Peers]:
+        if not path.isfile(self.file):
+            return None, {}
+        try:
+            with open(self.file, "r") as data:
+                cached = json.load(data)
+            return cached["version"], {
+                int(chat): (access_hash, kind) for chat, access_hash, kind in cached["peers"]
+            }
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            LOGGER.warning(f"Ignoring unreadable {self.file}: {err}")
+            return None, {}
+
+    async def _restore(self, cached: Peers, chats: Set[int]) -> int:
+        """Put cached hashes of chats the session doesn't know into its storage"""
+        missing = []
+        for chat in chats & cached.keys():
+            try:
+                await self.client.storage.get_peer_by_id(chat)
+            except KeyError:
+                access_hash, kind = cached[chat]
+                missing.append((chat, access_hash, kind, None, None))
+        if missing:
+            await self.client.storage.update_peers(missing)
+        return len(missing)
+
+    async def _resolve(self, chats: Iterable[int]) -> Tuple[Peers, Set[int]]:
+        semaphore = asyncio.Semaphore(max(1, PEER_WARMUP_CONCURRENCY))
+        resolved: Peers = {}
+        failed: Set[int] = set()
+
+        async def resolve(chat: int):
+            async with semaphore:
+                try:
+                    entry = _peer_entry(await self.client.resolve_peer(chat))
+                except Exception as err:
+                    LOGGER.debug("%s could not resolve %s: %s", self.name, chat, err)
+                    failed.add(chat)
+                    return
+            if entry is not None:
+                resolved[entry[0]] = entry[1:]
+
+        await asyncio.gather(*(resolve(chat) for chat in chats))
+        return resolved, failed
+
+    async def warm_up(self, chats: Set[int]) -> Set[int]:
+        """Resolve all chats concurrently, returns those that can't be resolved"""
+        timings: List[str] = []
+        started = phase = time.monotonic()
+
+        def lap(name: str):
+            nonlocal phase
+            now = time.monotonic()
+            timings.append(f"{name} {now - phase:.2f}s")
+            phase = now
+
+        version, cached = self._load()
+        restored = await self._restore(cached, chats)
+        current = config_version(chats)
+        lap("cache")
+
+        # 缓存里有的已经放回会话，只查新增的和上次失败的
+        known = chats & cached.keys()
+        resolved, failed = await self._resolve(chats - known)
+        resolved.update((chat, cached[chat]) for chat in known)
+        lap("resolve")
+
+        if failed:
+            # 没加入过对话列表的频道只能从对话列表里拿到 access hash
+            async for _ in self.client.get_dialogs():
+                pass
+            retried, failed = await self._resolve(failed)
+            resolved.update(retried)
+            lap("dialogs")
+
+        peers = [[chat, access_hash, kind] for chat, (access_hash, kind) in resolved.items()]
+        data = json.dumps({"version": current, "peers": sorted(peers)})
+        try:
+            await asyncio.to_thread(write_atomic, self.file, data)
+        except OSError as err:
+            LOGGER.error(f"Failed to save {self.file}: {err}")
+
+        changed = "" if version in (None, current) else ", config changed since the last start"
+        LOGGER.info(
+            f"{self.name}: {len(resolved)}/{len(chats)} chats ready in"
+            f" {time.monotonic() - started:.2f}s ({', '.join(timings)};"
+            f" {restored} restored from cache{changed})"
+        )
+        if failed:
+            LOGGER.warning(
+                f"{self.name} can't access {sorted(failed)}, is the account a member of these chats?"
+            )
+        return failed
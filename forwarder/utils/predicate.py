@@ -0,0 +1,237 @@
+import re
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from pyrogram.types import Message
+
+from forwarder import LOGGER, REGEX_TIMEOUT
+from forwarder.utils.message import KeywordMatcher
+
+try:
+    import regex
+except ImportError:  # 没有时不能限制匹配时间，regex 条件在加载时报错
+    regex = None
+
+# 编译条件时可能出现的正则错误
+_PATTERN_ERRORS = (re.error,) if regex is None else (re.error, regex.error)
+
+# 各类条件的相对开销，组合条件按开销从小到大短路求值
+ATTRIBUTE_COST = 1
+ENTITY_COST = 2
+TEXT_COST = 10
+REGEX_COST = 50
+
+_LINK_ENTITIES = frozenset({"url", "text_link"})
+
+Test = Callable[[Sequence[Message], str], bool]
+
+
+class Predicate:
+    """A compiled `when` condition of a rule.
+
+    `test(messages, text)` gets the message, or all messages of an album, and
+    the text the keyword filters see.
+    """
+
+    __slots__ = ("cost", "test", "parts")
+
+    def __init__(self, cost: int, test: Test, parts: Tuple["Predicate", ...] = ()):
+        self.cost = cost
+        self.test = test
+        # all 的各项，可以分开判断
+        self.parts = parts
+
+
+def _ids(value) -> frozenset:
+    items = value if isinstance(value, list) else [value]
+    return frozenset(int(item) for item in items)
+
+
+def _sender(messages: Sequence[Message]) -> Optional[int]:
+    if not messages:
+        return None
+    first = messages[0]
+    if first.from_user is not None:
+        return first.from_user.id
+    if first.sender_chat is not None:
+        return first.sender_chat.id
+    return None
+
+
+def _forwarded_from(messages: Sequence[Message]) -> Optional[int]:
+    if not messages:
+        return None
+    first = messages[0]
+    if first.forward_from_chat is not None:
+        return first.forward_from_chat.id
+    if first.forward_from is not None:
+        return first.forward_from.id
+    return None
+
+
+def _media(value) -> Predicate:
+    kinds = frozenset(value if isinstance(value, list) else [value])
+
+    def test(messages, text):
+        # "text" 表示没有媒体的纯文本消息
+        return any(
+            (message.media.value if message.media else "text") in kinds for message in messages
+        )
+
+    return Predicate(ATTRIBUTE_COST, test)
+
+
+def _sender_in(value) -> Predicate:
+    ids = _ids(value)
+    return Predicate(ATTRIBUTE_COST, lambda messages, text: _sender(messages) in ids)
+
+
+def _forwarded_from_in(value) -> Predicate:
+    if isinstance(value, bool):
+        # true: 任意转发来的消息，false: 原创消息
+        def test(messages, text):
+            forwarded = bool(messages) and (
+                messages[0].forward_date is not None or _forwarded_from(messages) is not None
+            )
+            return forwarded == value
+
+        return Predicate(ATTRIBUTE_COST, test)
+
+    ids = _ids(value)
+    return Predicate(ATTRIBUTE_COST, lambda messages, text: _forwarded_from(messages) in ids)
+
+
+def _has_link(value) -> Predicate:
+    if not isinstance(value, bool):
+        raise TypeError("has_link must be true or false")
+
+    def test(messages, text):
+        found = any(
+            entity.type.value in _LINK_ENTITIES
+            for message in messages
+            for entity in (message.entities or message.caption_entities or ())
+        )
+        return found == value
+
+    return Predicate(ENTITY_COST, test)
+
+
+def _text(value) -> Predicate:
+    words = value if isinstance(value, list) else [value]
+    if not words or not all(isinstance(word, str) and word for word in words):
+        raise TypeError("text must be a word or an array of words")
+    matcher = KeywordMatcher(words)
+    return Predicate(TEXT_COST, lambda messages, text: bool(matcher.search(text)))
+
+
+def _regex(value) -> Predicate:
+    if not isinstance(value, str):
+        raise TypeError("regex must be a string")
+    if regex is None:
+        raise TypeError("regex conditions need the regex package (pip install regex)")
+    # 配置有误时在加载阶段报错
+    pattern = regex.compile(value)
+
+    def test(messages, text):
+        try:
+            return pattern.search(text, timeout=REGEX_TIMEOUT) is not None
+        except TimeoutError:
+            LOGGER.warning("Regex %r gave up after %ss, not matching", value, REGEX_TIMEOUT)
+            return False
+
+    return Predicate(REGEX_COST, test)
+
+
+def _conjunction(parts: Sequence[Predicate]) -> Predicate:
+    tests = tuple(part.test for part in parts)
+
+    def test(messages, text):
+        for check in tests:
+            if not check(messages, text):
+                return False
+        return True
+
+    return Predicate(sum(part.cost for part in parts), test, tuple(parts))
+
+
+def _all(value) -> Predicate:
+    return _conjunction(_children(value, "all"))
+
+
+def _any(value) -> Predicate:
+    parts = _children(value, "any")
+    tests = tuple(part.test for part in parts)
+
+    def test(messages, text):
+        for check in tests:
+            if check(messages, text):
+                return True
+        return False
+
+    return Predicate(sum(part.cost for part in parts), test)
+
+
+def _not(value) -> Predicate:
+    part = compile_predicate(value)
+    return Predicate(part.cost, lambda messages, text: not part.test(messages, text))
+
+
+_NODES = {
+    "all": _all,
+    "any": _any,
+    "not": _not,
+    "media": _media,
+    "sender": _sender_in,
+    "forwarded_from": _forwarded_from_in,
+    "has_link": _has_link,
+    "text": _text,
+    "regex": _regex,
+}
+
+
+def _children(value, name: str) -> List[Predicate]:
+    if not isinstance(value, list) or not value:
+        raise TypeError(f"{name} must be a non-empty array of conditions")
+    # 便宜的条件先判断
+    return sorted((compile_predicate(item) for item in value), key=lambda part: part.cost)
+
+
+def compile_predicate(node: dict) -> Predicate:
+    """Compile a `when` condition of chat_list.json
+
+    Raises:
+        ValueError: when the condition is invalid
+    """
+    if not isinstance(node, dict) or not node:
+        raise ValueError(f"condition must be a non-empty object, got {node!r}")
+    if len(node) > 1:
+        # 同一个对象里的多个条件视为 all
+        return _all([{key: value} for key, value in node.items()])
+
+    key, value = next(iter(node.items()))
+    build = _NODES.get(key)
+    if build is None:
+        raise ValueError(f"unknown condition {key!r}, expected one of {sorted(_NODES)}")
+    try:
+        return build(value)
+    except (TypeError, *_PATTERN_ERRORS) as err:
+        raise ValueError(f"invalid {key!r} condition: {err}") from err
+
+
+def split_predicate(
+    predicate: Optional[Predicate], cost: int
+) -> Tuple[Optional[Predicate], Optional[Predicate]]:
+    """Split into the conditions cheaper than `cost` and the rest, so something of
+    that cost can run in between. Either part may be None."""
+    if predicate is None:
+        return None, None
+    parts = predicate.parts or (predicate,)
+    return (
+        _join([part for part in parts if part.cost < cost]),
+        _join([part for part in parts if part.cost >= cost]),
+    )
+
+
+def _join(parts: List[Predicate]) -> Optional[Predicate]:
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else _conjunction(parts)
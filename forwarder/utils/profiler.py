@@ -0,0 +1,61 @@
+import asyncio
+import cProfile
+import pstats
+import time
+from os import path
+from typing import List, Tuple
+
+from forwarder import DATA_DIR
+
+# (累计秒数, 自身秒数, 调用次数, 函数)
+ProfileRow = Tuple[float, float, int, str]
+
+
+class Profiler:
+    """Profile the running process with cProfile for a while, on demand.
+
+    All handlers, send workers and pyrogram's update parsing run on the event
+    loop thread, so a profiler enabled from a coroutine sees all of them.
+    cProfile slows every call down, which is why it only runs when asked and
+    only one profile at a time.
+    """
+
+    def __init__(self):
+        self.running = False
+
+    async def run(self, seconds: float) -> Tuple[pstats.Stats, str]:
+        """Profile for `seconds`, returns the stats and the file they were saved to
+
+        Raises:
+            RuntimeError: when a profile is already running
+        """
+        if self.running:
+            raise RuntimeError("a profile is already running")
+        self.running = True
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+        finally:
+            self.running = False
+
+        file = path.join(DATA_DIR, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+        await asyncio.to_thread(profile.dump_stats, file)
+        return pstats.Stats(profile), file
+
+
+def top_functions(stats: pstats.Stats, limit: int) -> List[ProfileRow]:
+    """The functions with the most cumulative time"""
+    rows = []
+    for (file, line, name), (_, calls, own, cumulative, _) in stats.stats.items():
+        # 内置函数没有文件和行号
+        where = f" ({path.basename(file)}:{line})" if line else ""
+        rows.append((cumulative, own, calls, f"{name}{where}"))
+    rows.sort(reverse=True)
+    return rows[:limit]
+
+
+profiler = Profiler()
@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Token bucket rate limiter that learns from FloodWait errors.
+
+    `rate` is tokens per second, a rate of 0 disables the limit. Every FloodWait
+    pauses the bucket and halves its rate, successful sends slowly bring the
+    rate back to `base_rate`.
+    """
+
+    __slots__ = ("base_rate", "rate", "capacity", "_tokens", "_updated", "_paused_until")
+
+    MIN_RATE_FACTOR = 0.05
+    RECOVER_FACTOR = 0.05
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token can be taken, 0 if one is available now"""
+        now = time.monotonic()
+        self._refill(now)
+
+        wait = max(0.0, self._paused_until - now)
+        if self.rate > 0 and self._tokens < 1:
+            wait = max(wait, (1 - self._tokens) / self.rate)
+        return wait
+
+    def consume(self):
+        """Take a token, call only after `delay()` returned 0"""
+        if self.rate > 0:
+            self._tokens -= 1
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        while True:
+            wait = self.delay()
+            if wait <= 0:
+                self.consume()
+                return
+            await asyncio.sleep(wait)
+
+    @property
+    def paused(self) -> bool:
+        return self._paused_until > time.monotonic()
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for the next `seconds`"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def penalize(self, seconds: float):
+        """Pause for a FloodWait and lower the rate"""
+        self.pause(seconds)
+        if self.rate > 0:
+            self.rate = max(self.base_rate * self.MIN_RATE_FACTOR, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+    def reward(self):
+        """Recover the rate a little after a successful send"""
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * self.RECOVER_FACTOR)
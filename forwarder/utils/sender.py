@@ -0,0 +1,838 @@
+import asyncio
+import sqlite3
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from itertools import count, islice
+from os import path
+from typing import Deque, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+from pyrogram import Client
+from pyrogram.errors import ChatForwardsRestricted, FloodWait, Unauthorized
+from pyrogram.types import Message
+
+from forwarder import (
+    app,
+    LOGGER,
+    DATA_DIR,
+    MAX_CONCURRENT_SENDS,
+    MAX_SEND_ATTEMPTS,
+    REMOVE_TAG,
+    REUPLOAD_PROTECTED,
+    CHAT_SEND_RATE,
+    DEDUP_TTL,
+    DEDUP_SIZE,
+    DEDUP_SNAPSHOT,
+    DESTINATION_OVERFLOW,
+    MAX_DESTINATION_BACKLOG,
+    SKIP_NOTICE_INTERVAL,
+)
+from forwarder.utils.chat import (
+    DEFAULT_OVERFLOW,
+    DEFAULT_PRIORITY,
+    PRIORITIES,
+    ChatConfig,
+    ForwardConfig,
+    Overflow,
+    parse_overflow,
+)
+from forwarder.utils.dedup import DedupCache
+from forwarder.utils.lifecycle import on_shutdown, on_startup
+from forwarder.utils.mapping import message_map
+from forwarder.utils.metrics import (
+    FLOODWAIT_SECONDS,
+    MESSAGES_FAILED,
+    MESSAGES_SENT,
+    MESSAGES_SKIPPED,
+    REGISTRY,
+    SEND_LATENCY,
+    STAGE_TIME,
+    Counter,
+    Gauge,
+)
+from forwarder.utils.outbox import Outbox
+from forwarder.utils.ratelimit import TokenBucket
+from forwarder.utils.senders import SENDER_MESSAGES, Sender, SenderPool, senders
+from forwarder.utils.transfer import transfers
+
+# 发送失败后的重试间隔: RETRY_BASE_DELAY * 2^(n-1)，最多 RETRY_MAX_DELAY 秒
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 300
+
+# worker 处理某个目标出错后，多少秒后再试
+WORKER_RETRY_DELAY = 5
+
+# 重新上传的并发已满时，等待多少秒再试
+TRANSFER_RETRY_DELAY = 1
+
+# forward_messages 一次最多 100 条
+MAX_FORWARD_BATCH = 100
+
+# 去重缓存快照的保存间隔 (秒)
+DEDUP_SNAPSHOT_INTERVAL = 300
+
+# 管理命令的回复排在所有规则之前
+URGENT_PRIORITY = 0
+LOWEST_PRIORITY = max(PRIORITIES.values())
+# 有更高优先级的发送在等待时，隔多少秒再检查
+PRIORITY_RETRY_DELAY = 0.05
+
+# (目标, 优先级)，每个目标的每个优先级各有一条队列
+LaneKey = Tuple[int, int]
+
+# 积压超出上限跳过消息后，发往目标的提示
+SKIP_NOTICE = "⚠️ 消息过多，已跳过 {count} 条"
+
+
+async def send_message(
+    source: int,
+    message_ids: Sequence[int],
+    chat_id: int,
+    thread_id: int = None,
+    album: bool = False,
+    client: Client = app,
+) -> Union[Message, List[Message], None]:
+    if source in transfers.protected:
+        return await transfers.send(client, source, message_ids, chat_id, thread_id, album)
+    try:
+        return await _forward(source, message_ids, chat_id, thread_id, album, client)
+    except ChatForwardsRestricted:
+        if not REUPLOAD_PROTECTED:
+            raise
+        transfers.protect(source)
+        return await transfers.send(client, source, message_ids, chat_id, thread_id, album)
+
+
+async def _forward(
+    source: int,
+    message_ids: Sequence[int],
+    chat_id: int,
+    thread_id: Optional[int],
+    album: bool,
+    client: Client,
+) -> Union[Message, List[Message], None]:
+    if REMOVE_TAG:
+        if album:
+            # copy_media_group 根据其中任意一项复制整个相册
+            return await client.copy_media_group(
+                chat_id, source, message_ids[0], reply_to_message_id=thread_id
+            )
+        return await client.copy_message(
+            chat_id, source, message_ids[0], reply_to_message_id=thread_id
+        )
+    return await client.forward_messages(chat_id, source, list(message_ids))
+
+
+def record_sent(
+    source: int,
+    message_ids: Sequence[int],
+    chat_id: int,
+    sent: Union[Message, List[Message], None],
+    sender: Sender,
+):
+    """Remember which destination messages the source messages became"""
+    if message_map is None or sent is None:
+        return
+    sent = [message for message in (sent if isinstance(sent, list) else [sent]) if message]
+    # 相册里有无法重新发送的项时对不上，只记录单条消息
+    if len(sent) != len(message_ids):
+        if len(message_ids) > 1:
+            return
+        sent = sent[-1:]
+    copied = REMOVE_TAG or source in transfers.protected
+    pairs = [(message_id, message.id) for message_id, message in zip(message_ids, sent)]
+    try:
+        message_map.add(source, pairs, chat_id, sender.name, copied)
+    except sqlite3.Error as err:
+        LOGGER.error("Failed to record forwarded messages of %s: %s", source, err)
+
+
+class SendJob:
+    __slots__ = (
+        "id",
+        "source",
+        "message_id",
+        "chat_id",
+        "topic",
+        "media_group",
+        "reply_to",
+        "priority",
+        "attempts",
+        "rule",
+        "created",
+        "received",
+    )
+
+    def __init__(
+        self,
+        job_id: int,
+        source: int,
+        message_id: int,
+        chat_id: int,
+        topic: Optional[int],
+        media_group: Optional[str] = None,
+        reply_to: Optional[int] = None,
+        priority: int = DEFAULT_PRIORITY,
+        attempts: int = 0,
+        rule: Optional[ForwardConfig] = None,
+        received: Optional[float] = None,
+    ):
+        self.id = job_id
+        self.source = source
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.topic = topic
+        self.media_group = media_group
+        self.reply_to = reply_to
+        self.priority = priority
+        self.attempts = attempts
+        # 重启后从 outbox 恢复的任务没有对应的规则
+        self.rule = rule
+        self.created = time.monotonic()
+        # 收到消息的时间 (monotonic)，历史消息和从 outbox 恢复的任务用入队时间
+        self.received = self.created if received is None else received
+
+    @property
+    def destination(self) -> str:
+        return f"{self.chat_id}#{self.topic}" if self.topic else str(self.chat_id)
+
+    @property
+    def rule_label(self) -> str:
+        return self.rule.label if self.rule is not None else "-"
+
+    @property
+    def log_fields(self) -> Dict[str, object]:
+        """`extra` of log records about this job, shown by LOG_FORMAT=json"""
+        return {"rule": self.rule_label, "source": self.source, "destination": self.destination}
+
+    def __repr__(self) -> str:
+        return f"{self.source}/{self.message_id} -> {self.destination}"
+
+
+class SendScheduler:
+    """Send to many destinations concurrently while keeping each destination in FIFO order.
+
+    Jobs are written to the outbox first and only removed once delivered, so a
+    restart resumes where the previous run stopped. Every destination chat has
+    a lane per rule priority and a lane is served by at most one worker at a
+    time, so messages of the same priority never overtake each other inside a
+    chat. Sends are throttled by a token bucket per sending account and one per
+    destination; a FloodWait or a failed send only pauses the lanes of the chat
+    that caused it, or moves them to another account when there are several.
+
+    Ready lanes are served in order of priority. An account's tokens go to the
+    best priority waiting for them, owner command replies (`urgent`) come
+    before everything, and the lowest priority only sends while the account
+    has tokens to spare.
+
+    With a `DedupCache`, content already sent to a destination is dropped
+    before it is queued.
+
+    A rule's `max_backlog` limits the messages of that rule waiting for each
+    destination, `backlog_limit` those of all rules. Above a limit its
+    overflow policy drops the oldest waiting messages (lowest priority first),
+    drops the new ones, keeps only new media or keeps one new message in N.
+    Destinations get one notice with the number of skipped messages instead.
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        senders: SenderPool,
+        concurrency: int,
+        chat_rate: float,
+        max_attempts: int,
+        dedup: Optional[DedupCache] = None,
+        backlog_limit: int = 0,
+        overflow: Overflow = DEFAULT_OVERFLOW,
+    ):
+        self._outbox = outbox
+        self._senders = senders
+        self.dedup = dedup
+        self._concurrency = max(1, concurrency)
+        self._chat_rate = chat_rate
+        self._max_attempts = max(1, max_attempts)
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._lanes: Dict[LaneKey, Deque[SendJob]] = {}
+        self._active: Set[LaneKey] = set()
+        # 正在等待合并窗口的目标，批次凑满时提前唤醒
+        self._batching: Dict[LaneKey, asyncio.TimerHandle] = {}
+        self._ready: Optional[asyncio.PriorityQueue] = None
+        self._sequence = count()
+        # 账号 -> 各优先级正在等待发送额度的数量
+        self._waiting: Dict[str, List[int]] = {}
+        self._backlog_limit = backlog_limit
+        self._overflow = overflow
+        # 每个目标和每个 (规则, 目标) 的积压数
+        self._chat_backlog: Dict[int, int] = {}
+        self._rule_backlog: Dict[Tuple[ForwardConfig, int], int] = {}
+        # 正在发送的批次长度，丢弃积压时保留
+        self._sending: Dict[LaneKey, int] = {}
+        # sample:N 已经收到的消息数
+        self._sampled: Dict[Tuple[Optional[ForwardConfig], int], int] = {}
+        # (目标, 话题) -> 上次提示后跳过的消息数
+        self.skipped: Dict[Tuple[int, Optional[int]], int] = {}
+        self._workers: List[asyncio.Task] = []
+        # 启动时间，第一次发送成功后清空
+        self._started: Optional[float] = None
+
+    def submit(
+        self,
+        source: int,
+        message_ids: Sequence[int],
+        rules: Iterable[ForwardConfig],
+        media_group: Optional[str] = None,
+        fingerprint: Optional[int] = None,
+        reply_to: Optional[int] = None,
+        media: bool = False,
+        received: Optional[float] = None,
+    ) -> None:
+        """Persist messages for the destinations of some rules and queue them, returns immediately
+
+        The messages of an album are queued together and sent in one call.
+        `fingerprint` identifies the content for deduplication, `reply_to` is
+        the source message the first message replies to, `media` tells the
+        media_only overflow policy whether the messages carry media, and
+        `received` is the `time.monotonic()` the messages arrived at.
+        """
+        dedup = self.dedup if fingerprint is not None else None
+        targets = []
+        for rule in rules:
+            for chat in rule.destination:
+                key = (chat.get_id(), chat.get_topic(), fingerprint)
+                if dedup is not None and dedup.seen(key):
+                    continue
+                if not self._admit(rule, chat, len(message_ids), media):
+                    continue
+                # 只记住真正排队的，被积压上限跳过的内容以后还能再发
+                if dedup is not None:
+                    dedup.add(key)
+                targets.append((rule, chat))
+        rows = [
+            (
+                source,
+                message_id,
+                chat.get_id(),
+                chat.get_topic(),
+                media_group,
+                reply_to if index == 0 else None,
+                rule.priority,
+            )
+            for rule, chat in targets
+            for index, message_id in enumerate(message_ids)
+        ]
+        if not rows:
+            return
+        ids = self._outbox.put_many(rows)
+
+        # 启动前提交的任务已经在 outbox 里，start() 会统一加载
+        if self._ready is None:
+            return
+        jobs = iter(zip(ids, rows))
+        for rule, _ in targets:
+            for job_id, row in islice(jobs, len(message_ids)):
+                self._push(SendJob(job_id, *row, rule=rule, received=received))
+
+    def _admit(self, rule: ForwardConfig, chat: ChatConfig, count: int, media: bool) -> bool:
+        """Apply the backlog limits of the rule and of the destination to new messages,
+        returns whether to queue them"""
+        if not rule.max_backlog and not self._backlog_limit:
+            return True
+        chat_id = chat.get_id()
+        limits = (
+            (rule, rule.max_backlog, self._rule_backlog, (rule, chat_id), rule.overflow),
+            (None, self._backlog_limit, self._chat_backlog, chat_id, self._overflow),
+        )
+        for owner, limit, backlogs, key, (policy, every) in limits:
+            # 读当前值: 规则的 drop_oldest 可能刚减少了目标的积压
+            backlog = backlogs.get(key, 0)
+            if not limit or backlog + count <= limit:
+                continue
+            if policy == "drop_oldest":
+                self._drop_oldest(chat_id, owner, backlog + count - limit)
+                continue
+            if policy == "media_only" and media:
+                continue
+            if policy == "sample":
+                seen = self._sampled.get((owner, chat_id), 0)
+                self._sampled[(owner, chat_id)] = seen + 1
+                if seen % every == 0:
+                    continue
+            self._skip(rule.label, repr(chat), (chat_id, chat.get_topic()), count)
+            return False
+        return True
+
+    def _drop_oldest(self, chat_id: int, rule: Optional[ForwardConfig], count: int):
+        """Remove at least `count` waiting messages for a destination, of one rule or of all,
+        lowest priority and oldest first. Albums go whole, the batch being sent stays."""
+        for priority in sorted(PRIORITIES.values(), reverse=True):
+            if count <= 0:
+                break
+            key = (chat_id, priority)
+            lane = self._lanes.get(key)
+            if not lane:
+                continue
+            sending = self._sending.get(key, 0)
+            kept = list(islice(lane, sending))
+            dropped: List[SendJob] = []
+            album = None
+            for job in islice(lane, sending, None):
+                in_album = album is not None and job.media_group == album
+                if (count > 0 or in_album) and (rule is None or job.rule is rule):
+                    dropped.append(job)
+                    count -= 1
+                    album = job.media_group
+                else:
+                    kept.append(job)
+                    album = None
+            if not dropped:
+                continue
+            # 原地修改，正在发送的 worker 还持有这个队列
+            lane.clear()
+            lane.extend(kept)
+            self._outbox.ack([job.id for job in dropped])
+            for job in dropped:
+                self._dequeued(job)
+                self._skip(job.rule_label, job.destination, (job.chat_id, job.topic), 1)
+
+    def _skip(self, label: str, destination: str, target: Tuple[int, Optional[int]], count: int):
+        MESSAGES_SKIPPED.inc(label, destination, amount=count)
+        self.skipped[target] = self.skipped.get(target, 0) + count
+
+    def _dequeued(self, job: SendJob):
+        self._chat_backlog[job.chat_id] -= 1
+        if not self._chat_backlog[job.chat_id]:
+            del self._chat_backlog[job.chat_id]
+        if job.rule is not None:
+            key = (job.rule, job.chat_id)
+            self._rule_backlog[key] -= 1
+            if not self._rule_backlog[key]:
+                del self._rule_backlog[key]
+
+    async def send_skip_notices(self):
+        """Tell every destination how many messages were skipped since the last notice"""
+        skipped, self.skipped = self.skipped, {}
+        sender = self._senders.main
+        for (chat_id, topic), count in skipped.items():
+            await self.acquire(sender, PRIORITIES["high"])
+            await self.bucket(chat_id).acquire()
+            try:
+                await sender.client.send_message(
+                    chat_id, SKIP_NOTICE.format(count=count), reply_to_message_id=topic
+                )
+            except FloodWait as err:
+                self.bucket(chat_id).penalize(err.value + 0.2)
+                self.skipped[(chat_id, topic)] = self.skipped.get((chat_id, topic), 0) + count
+            except Exception as err:
+                LOGGER.warning(
+                    "Failed to tell %s about %d skipped messages: %s", chat_id, count, err
+                )
+
+    def pending(self) -> int:
+        """Number of messages waiting to be sent"""
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def backlog_age(self) -> float:
+        """Seconds the oldest waiting message has been queued, 0 if none"""
+        created = [lane[0].created for lane in self._lanes.values() if lane]
+        return time.monotonic() - min(created) if created else 0.0
+
+    def dead(self) -> int:
+        """Number of messages given up after too many failures"""
+        return self._outbox.dead()
+
+    def start(self):
+        """Load undelivered jobs and start the workers"""
+        if self._ready is not None:
+            return
+        self._ready = asyncio.PriorityQueue()
+
+        jobs = self._outbox.pending()
+        for row in jobs:
+            self._push(SendJob(*row))
+        if jobs:
+            LOGGER.info(f"Resuming {len(jobs)} undelivered messages from the outbox")
+
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._concurrency)]
+        self._started = time.monotonic()
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._outbox.close()
+
+    def _push(self, job: SendJob):
+        key = (job.chat_id, job.priority)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = deque()
+        lane.append(job)
+        self._chat_backlog[job.chat_id] = self._chat_backlog.get(job.chat_id, 0) + 1
+        if job.rule is not None:
+            backlog = (job.rule, job.chat_id)
+            self._rule_backlog[backlog] = self._rule_backlog.get(backlog, 0) + 1
+
+        if key not in self._active:
+            self._active.add(key)
+            self._enqueue(key)
+        elif key in self._batching and len(lane) >= self._batch_limit(lane[0]):
+            self._batching.pop(key).cancel()
+            self._enqueue(key)
+
+    def _enqueue(self, key: LaneKey):
+        # 同一优先级内先到先服务
+        self._ready.put_nowait((key[1], next(self._sequence), key))
+
+    def bucket(self, key: int) -> TokenBucket:
+        """Rate limiter of a destination chat"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self._chat_rate)
+        return bucket
+
+    def _wake_later(self, key: LaneKey, delay: float):
+        asyncio.get_running_loop().call_later(delay, self._enqueue, key)
+
+    def _wake_batch(self, key: LaneKey):
+        del self._batching[key]
+        self._enqueue(key)
+
+    def _outranked(self, sender: Sender, priority: int) -> bool:
+        """Whether a better priority is waiting for the account's tokens"""
+        waiting = self._waiting.get(sender.name)
+        return waiting is not None and any(waiting[:priority])
+
+    @asynccontextmanager
+    async def _waiting_for(self, sender: Sender, priority: int):
+        waiting = self._waiting.get(sender.name)
+        if waiting is None:
+            waiting = self._waiting[sender.name] = [0] * (LOWEST_PRIORITY + 1)
+        waiting[priority] += 1
+        try:
+            yield
+        finally:
+            waiting[priority] -= 1
+
+    async def acquire(self, sender: Sender, priority: int):
+        """Take a token of the account once no better priority is waiting for one"""
+        async with self._waiting_for(sender, priority):
+            while True:
+                wait = sender.bucket.delay()
+                if wait <= 0 and not self._outranked(sender, priority):
+                    sender.bucket.consume()
+                    return
+                await asyncio.sleep(wait or PRIORITY_RETRY_DELAY)
+
+    @asynccontextmanager
+    async def urgent(self, sender: Sender):
+        """Hold back queued sends of an account while the block runs"""
+        async with self._waiting_for(sender, URGENT_PRIORITY):
+            yield
+
+    async def _worker(self):
+        while True:
+            _, _, key = await self._ready.get()
+            try:
+                await self._serve(key)
+            except Exception:
+                # 例如 outbox 写入失败，不能让 worker 退出，否则这个目标再也不会发送
+                LOGGER.exception(
+                    "Send worker failed on %s, retrying in %ss", key, WORKER_RETRY_DELAY
+                )
+                self._wake_later(key, WORKER_RETRY_DELAY)
+
+    async def _serve(self, key: LaneKey):
+        """Send the next batch of a ready lane, or schedule the lane for later"""
+        chat_id, priority = key
+        lane = self._lanes.get(key)
+        bucket = self.bucket(chat_id)
+
+        # 积压被丢弃后队列可能已经空了
+        if not lane:
+            self._lanes.pop(key, None)
+            self._active.discard(key)
+            return
+
+        # 目标还在限速、FloodWait 或重试等待中，不占用 worker，到时间再排队
+        wait = bucket.delay()
+        if wait > 0:
+            self._wake_later(key, wait)
+            return
+
+        batch = self._take_batch(lane)
+
+        # 合并窗口还没结束且批次未满，等窗口结束时再发
+        wait = self._batch_wait(batch)
+        if wait > 0:
+            self._batching[key] = asyncio.get_running_loop().call_later(
+                wait, self._wake_batch, key
+            )
+            return
+
+        # 重新上传要占用较长时间，并发已满时先让 worker 发送其他目标
+        if batch[0].source in transfers.protected and transfers.busy:
+            self._wake_later(key, TRANSFER_RETRY_DELAY)
+            return
+
+        sender, wait = self._senders.pick(chat_id, batch[0].source)
+        if sender is None:
+            self._wake_later(key, wait)
+            return
+
+        # 有更高优先级在等待，或最低优先级而账号没有剩余额度时，不占用 worker
+        wait = sender.bucket.delay() if priority == LOWEST_PRIORITY else 0
+        if wait > 0 or self._outranked(sender, priority):
+            self._wake_later(key, max(wait, PRIORITY_RETRY_DELAY))
+            return
+
+        self._sending[key] = len(batch)
+        try:
+            await self.acquire(sender, priority)
+            # 等待账号额度期间目标可能被限流
+            wait = bucket.delay()
+            if wait > 0:
+                self._wake_later(key, wait)
+                return
+            bucket.consume()
+            delivered = await self._deliver(batch, bucket, sender)
+        finally:
+            del self._sending[key]
+
+        if not delivered:
+            self._wake_later(key, bucket.delay())
+            return
+
+        for _ in batch:
+            self._dequeued(lane.popleft())
+        # 排到同一优先级的队尾，让其他目标轮流发送
+        if lane:
+            self._enqueue(key)
+        else:
+            del self._lanes[key]
+            self._active.discard(key)
+
+    @staticmethod
+    def _batch_limit(job: SendJob) -> int:
+        """How many messages may be forwarded together with this job, 1 if none"""
+        if REMOVE_TAG or job.rule is None or job.rule.batch_window <= 0:
+            return 1
+        return max(1, min(MAX_FORWARD_BATCH, job.rule.batch_size))
+
+    def _take_batch(self, lane: Deque[SendJob]) -> List[SendJob]:
+        """The head job plus the following jobs that can go in the same API call
+
+        That is the rest of its album, and with a batch window (forward mode only)
+        the consecutive messages from the same source. A later album that does not
+        fit in the size limit is left whole for the next batch.
+        """
+        head = lane[0]
+        limit = self._batch_limit(head)
+        if head.media_group is None and limit == 1:
+            return [head]
+
+        batch = [head]
+        for job in islice(lane, 1, None):
+            if (
+                job.source != head.source
+                or job.topic != head.topic
+                or job.message_id <= batch[-1].message_id
+            ):
+                break
+            in_album = head.media_group is not None and job.media_group == head.media_group
+            if not in_album and (len(batch) >= limit or self._batch_limit(job) == 1):
+                break
+            batch.append(job)
+
+        # 批次是队列的前缀，截断在后面某个相册中间时整个相册留到下一批
+        tail = batch[-1].media_group
+        if (
+            tail is not None
+            and tail != head.media_group
+            and len(batch) < len(lane)
+            and lane[len(batch)].media_group == tail
+        ):
+            while batch[-1].media_group == tail:
+                batch.pop()
+        return batch
+
+    def _batch_wait(self, batch: List[SendJob]) -> float:
+        head = batch[0]
+        limit = self._batch_limit(head)
+        if limit == 1 or len(batch) >= limit:
+            return 0
+        return head.created + head.rule.batch_window - time.monotonic()
+
+    async def _deliver(self, batch: List[SendJob], bucket: TokenBucket, sender: Sender) -> bool:
+        """Send a batch, returns False when it should stay at the head of its lane"""
+        head = batch[0]
+        ids = [job.id for job in batch]
+        # 日志用 % 格式，级别未启用时不会格式化
+        fields = head.log_fields
+        LOGGER.debug(
+            "Forwarding message %s (%d items) with %s", head, len(batch), sender, extra=fields
+        )
+        started = time.perf_counter()
+        try:
+            sent = await send_message(
+                head.source,
+                [job.message_id for job in batch],
+                head.chat_id,
+                self._reply_target(head),
+                album=head.media_group is not None,
+                client=sender.client,
+            )
+        except FloodWait as err:
+            FLOODWAIT_SECONDS.inc(head.destination, amount=err.value)
+            if self._senders.rate_limited(sender, head.chat_id, head.source, err.value + 0.2):
+                LOGGER.warning(
+                    "Account %s rate limited for %s seconds, sending to %s with another account",
+                    sender,
+                    err.value,
+                    head.chat_id,
+                    extra=fields,
+                )
+                return False
+            LOGGER.warning(
+                "Rate limited on %s, pausing it for %s seconds",
+                head.chat_id,
+                err.value,
+                extra=fields,
+            )
+            bucket.penalize(err.value + 0.2)
+            return False
+        except Exception as err:
+            if isinstance(err, Unauthorized) and self._senders.unauthorized(
+                sender, head.chat_id, head.source, err
+            ):
+                return False
+            self._count(MESSAGES_FAILED, batch)
+            attempts = head.attempts + 1
+            for job in batch:
+                job.attempts = attempts
+            if attempts >= self._max_attempts:
+                LOGGER.error(
+                    "Giving up on message %s after %d attempts: %s",
+                    head,
+                    attempts,
+                    err,
+                    extra=fields,
+                )
+                self._outbox.bury(ids, repr(err))
+                return True
+
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+            LOGGER.warning(
+                "Failed to forward message %s due to %s, retrying in %ss",
+                head,
+                err,
+                delay,
+                extra=fields,
+            )
+            self._outbox.retry(ids, attempts, repr(err))
+            bucket.pause(delay)
+            return False
+        finally:
+            STAGE_TIME.observe(time.perf_counter() - started, "send")
+
+        bucket.reward()
+        sender.bucket.reward()
+        # 已经发出去了，不能因为 outbox 写入失败而再发一次
+        try:
+            self._outbox.ack(ids)
+        except sqlite3.Error as err:
+            LOGGER.error("Failed to remove sent message %s from the outbox: %s", head, err)
+        record_sent(head.source, [job.message_id for job in batch], head.chat_id, sent, sender)
+        self._count(MESSAGES_SENT, batch)
+        SENDER_MESSAGES.inc(sender.name, amount=len(batch))
+        now = time.monotonic()
+        for job in batch:
+            SEND_LATENCY.observe(now - job.received)
+        if self._started is not None:
+            LOGGER.info(f"First message sent {now - self._started:.2f}s after the queue started")
+            self._started = None
+        return True
+
+    @staticmethod
+    def _reply_target(job: SendJob) -> Optional[int]:
+        """The message to reply to in the destination, otherwise the topic"""
+        if job.reply_to is not None and message_map is not None:
+            reply = message_map.find(job.source, job.reply_to, job.chat_id)
+            if reply is not None:
+                return reply
+        return job.topic
+
+    @staticmethod
+    def _count(counter: Counter, batch: List[SendJob]):
+        for job in batch:
+            counter.inc(job.rule_label, job.destination)
+
+
+DEDUP_FILE = path.join(DATA_DIR, "dedup.json")
+
+scheduler = SendScheduler(
+    Outbox(path.join(DATA_DIR, "outbox.db")),
+    senders,
+    MAX_CONCURRENT_SENDS,
+    CHAT_SEND_RATE,
+    MAX_SEND_ATTEMPTS,
+    DedupCache(DEDUP_TTL, DEDUP_SIZE) if DEDUP_TTL > 0 else None,
+    MAX_DESTINATION_BACKLOG,
+    parse_overflow(DESTINATION_OVERFLOW),
+)
+
+
+async def reply_urgently(message: Message, text: str, **kwargs) -> Message:
+    """Reply to an owner command ahead of the queued forwards"""
+    async with scheduler.urgent(senders.main):
+        return await message.reply(text, **kwargs)
+
+
+async def edit_urgently(message: Message, text: str, **kwargs) -> Message:
+    """Edit a reply to an owner command ahead of the queued forwards"""
+    async with scheduler.urgent(senders.main):
+        return await message.edit_text(text, **kwargs)
+
+
+async def _snapshot_dedup():
+    while True:
+        await asyncio.sleep(DEDUP_SNAPSHOT_INTERVAL)
+        try:
+            await scheduler.dedup.save(DEDUP_FILE)
+        except OSError as err:
+            LOGGER.error(f"Failed to save dedup snapshot: {err}")
+
+
+async def _notify_skipped():
+    while True:
+        await asyncio.sleep(SKIP_NOTICE_INTERVAL)
+        await scheduler.send_skip_notices()
+
+
+REGISTRY.register(
+    Gauge("forwarder_queue_depth", "Messages waiting to be sent", scheduler.pending)
+)
+REGISTRY.register(
+    Gauge("forwarder_dead_jobs", "Messages given up after too many failures", scheduler.dead)
+)
+
+
+@on_startup
+async def start_scheduler():
+    if scheduler.dedup is not None and DEDUP_SNAPSHOT:
+        scheduler.dedup.load(DEDUP_FILE)
+        asyncio.create_task(_snapshot_dedup())
+    scheduler.start()
+    if SKIP_NOTICE_INTERVAL > 0:
+        asyncio.create_task(_notify_skipped())
+
+
+@on_shutdown
+async def stop_scheduler():
+    await scheduler.stop()
+    if scheduler.dedup is not None and DEDUP_SNAPSHOT:
+        try:
+            await scheduler.dedup.save(DEDUP_FILE)
+        except OSError as err:
+            LOGGER.error(f"Failed to save dedup snapshot: {err}")
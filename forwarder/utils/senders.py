@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+from bisect import bisect
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from pyrogram import Client
+from pyrogram.utils import get_peer_type
+
+from forwarder import (
+    API_HASH,
+    API_ID,
+    GLOBAL_SEND_RATE,
+    LOGGER,
+    PEER_WARMUP_CONCURRENCY,
+    SENDER_SESSIONS,
+    SENDER_USE_MAIN,
+    SESSION_NAME,
+    app,
+    proxy,
+)
+from forwarder.utils.lifecycle import on_shutdown, on_startup
+from forwarder.utils.metrics import REGISTRY, Counter, Gauge
+from forwarder.utils.peers import PeerCache, config_chats
+from forwarder.utils.ratelimit import TokenBucket
+
+# 每个账号在哈希环上的虚拟节点数，越多分布越均匀
+RING_REPLICAS = 100
+
+# 所有账号都不可用时多久后再检查 (秒)
+NO_SENDER_RETRY = 60
+
+SENDER_MESSAGES = REGISTRY.register(
+    Counter("forwarder_sender_messages_total", "Messages delivered per account", ["sender"])
+)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes.
+
+    Adding or removing a node only moves the keys of that node, the others
+    keep their assignment.
+    """
+
+    def __init__(self, nodes: Sequence[str], replicas: int = RING_REPLICAS):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+        self._count = len(set(nodes))
+
+    def walk(self, key) -> Iterator[str]:
+        """All nodes in order of preference for a key"""
+        if not self._nodes:
+            return
+        start = bisect(self._hashes, _hash(str(key)))
+        seen = set()
+        for offset in range(len(self._nodes)):
+            node = self._nodes[(start + offset) % len(self._nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == self._count:
+                    return
+
+
+class Sender:
+    """An account used for sending, with its own total rate limit"""
+
+    __slots__ = ("name", "client", "bucket", "disabled")
+
+    def __init__(self, name: str, client: Client, rate: float):
+        self.name = name
+        self.client = client
+        self.bucket = TokenBucket(rate, capacity=rate)
+        # 被封禁或登录失效，直到重启都不再使用
+        self.disabled = False
+
+    @property
+    def available(self) -> bool:
+        return not self.disabled and not self.bucket.paused
+
+    def __repr__(self) -> str:
+        return self.name
+
+
+class SenderPool:
+    """Spread destinations over several accounts.
+
+    Each destination is assigned to an account by consistent hashing. When that
+    account is rate limited or can no longer send, the destination moves to
+    the next account on the ring until it is back.
+
+    Only channels and supergroups share message ids between accounts, so
+    messages from other sources are always sent by the listening account.
+    """
+
+    def __init__(self, main: Sender, extra: List[Sender], use_main: bool = True):
+        self.main = main
+        self.extra = extra
+        self.senders = ([main] if use_main or not extra else []) + extra
+        self._by_name = {sender.name: sender for sender in self.senders}
+        self._ring = HashRing(list(self._by_name))
+
+    def candidates(self, chat_id: int, source: int) -> List[Sender]:
+        """Accounts that may send from a source to a destination, preferred first"""
+        if len(self.senders) == 1 or get_peer_type(source) != "channel":
+            return [self.main]
+        return [self._by_name[name] for name in self._ring.walk(chat_id)]
+
+    def get(self, name: str) -> Optional[Sender]:
+        """The account with this name, None if it isn't configured any more"""
+        if name == self.main.name:
+            return self.main
+        return self._by_name.get(name)
+
+    def pick(self, chat_id: int, source: int) -> Tuple[Optional[Sender], float]:
+        """The account to send with, or None and the seconds until one is available"""
+        candidates = self.candidates(chat_id, source)
+        for sender in candidates:
+            if sender.available:
+                return sender, 0
+        waits = [sender.bucket.delay() for sender in candidates if not sender.disabled]
+        return None, min(waits, default=NO_SENDER_RETRY)
+
+    def _has_alternative(self, sender: Sender, chat_id: int, source: int) -> bool:
+        return any(
+            other is not sender and other.available
+            for other in self.candidates(chat_id, source)
+        )
+
+    def rate_limited(self, sender: Sender, chat_id: int, source: int, seconds: float) -> bool:
+        """Rest an account after a FloodWait if another one can take over, returns
+        False when there is none and the destination has to wait instead"""
+        if not self._has_alternative(sender, chat_id, source):
+            return False
+        sender.bucket.penalize(seconds)
+        return True
+
+    def unauthorized(self, sender: Sender, chat_id: int, source: int, err: Exception) -> bool:
+        """Stop using a banned or logged out account if another one can take over"""
+        if not self._has_alternative(sender, chat_id, source):
+            return False
+        sender.disabled = True
+        LOGGER.error(f"Account {sender.name} can no longer send ({err}), using the others instead")
+        return True
+
+    def available(self) -> int:
+        return sum(sender.available for sender in self.senders)
+
+    async def start(self):
+        """Log in the extra accounts, then resolve the configured chats on all accounts
+        at once, so the first sends don't have to"""
+        for sender in self.extra:
+            try:
+                await sender.client.start()
+            except Exception as err:
+                sender.disabled = True
+                LOGGER.error(f"Failed to start sender account {sender.name}: {err}")
+                continue
+            LOGGER.info(f"Sender account {sender.name} is ready")
+
+        if PEER_WARMUP_CONCURRENCY <= 0:
+            return
+        chats = config_chats()
+        accounts = [self.main] + [sender for sender in self.extra if not sender.disabled]
+        results = await asyncio.gather(
+            *(PeerCache(sender.client, sender.name).warm_up(chats) for sender in accounts),
+            return_exceptions=True,
+        )
+        for sender, result in zip(accounts, results):
+            if isinstance(result, Exception):
+                LOGGER.error(f"Failed to resolve the chats of {sender.name}: {result}")
+
+    async def stop(self):
+        for sender in self.extra:
+            if sender.client.is_connected:
+                await sender.client.stop()
+
+
+senders = SenderPool(
+    Sender(SESSION_NAME, app, GLOBAL_SEND_RATE),
+    [
+        Sender(
+            name,
+            Client(name, api_id=int(API_ID), api_hash=API_HASH, proxy=proxy, no_updates=True),
+            GLOBAL_SEND_RATE,
+        )
+        for name in SENDER_SESSIONS
+    ],
+    SENDER_USE_MAIN,
+)
+
+REGISTRY.register(
+    Gauge("forwarder_senders_available", "Accounts that can send right now", senders.available)
+)
+
+
+# 在发送队列开始之前运行
+@on_startup
+async def start_senders():
+    await senders.start()
+
+
+@on_shutdown
+async def stop_senders():
+    await senders.stop()
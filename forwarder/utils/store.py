@@ -0,0 +1,114 @@
+import asyncio
+import errno
+import json
+import os
+import tempfile
+from typing import Optional, Tuple
+
+from forwarder import CONFIG, CONFIG_SAVE_DELAY, LOGGER, config_name
+from forwarder.utils.lifecycle import on_shutdown
+
+
+def write_atomic(path: str, data: str):
+    """Write a file through a temp file, fsync and rename, so it is never half written"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.replace(tmp, path)
+        except OSError as err:
+            # Docker 单文件挂载不能被 rename 覆盖，只能原地写入
+            if err.errno not in (errno.EBUSY, errno.EXDEV):
+                raise
+            os.unlink(tmp)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def file_signature(path: str) -> Optional[Tuple[int, int]]:
+    """Modification time and size of a file, None if it doesn't exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _write_config(path: str, data: str) -> Optional[Tuple[int, int]]:
+    write_atomic(path, data)
+    return file_signature(path)
+
+
+class ConfigStore:
+    """Persist CONFIG to chat_list.json in a background thread.
+
+    Edits made within `delay` seconds of each other, or while a write is in
+    progress, are written together. The file's signature after the last
+    write is kept, so the config watcher can tell its own writes from
+    outside edits.
+    """
+
+    def __init__(self, path: str, delay: float):
+        self._path = path
+        self._delay = delay
+        self._dirty = False
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+        self.signature: Optional[Tuple[int, int]] = None
+
+    @property
+    def pending(self) -> bool:
+        """Whether there are edits not written to the file yet"""
+        return self._dirty or self._timer is not None or self._task is not None
+
+    def save(self):
+        """Schedule a write of the current config"""
+        self._dirty = True
+        if self._timer is None and self._task is None:
+            self._timer = asyncio.get_running_loop().call_later(self._delay, self._start)
+
+    def _start(self):
+        self._timer = None
+        self._task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        try:
+            while self._dirty:
+                self._dirty = False
+                # 在事件循环里序列化，得到一致的快照
+                data = json.dumps(CONFIG, indent=4, ensure_ascii=False)
+                try:
+                    signature = await asyncio.to_thread(_write_config, self._path, data)
+                except OSError as err:
+                    LOGGER.error(f"Failed to save {self._path}: {err}")
+                else:
+                    self.signature = signature
+                    LOGGER.info(f"Configuration saved to {self._path}")
+        finally:
+            self._task = None
+
+    async def flush(self):
+        """Write pending changes now"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._start()
+        if self._task is not None:
+            await self._task
+
+
+config_store = ConfigStore(config_name, CONFIG_SAVE_DELAY)
+
+
+@on_shutdown
+async def flush_config():
+    await config_store.flush()
@@ -0,0 +1,294 @@
+import asyncio
+import io
+from collections import OrderedDict
+from tempfile import SpooledTemporaryFile
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from pyrogram import Client
+from pyrogram.errors import BadRequest
+from pyrogram.types import (
+    InputMediaAnimation,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+    Message,
+)
+
+from forwarder import LOGGER, TRANSFER_CACHE_SIZE, TRANSFER_CONCURRENCY, TRANSFER_MEMORY_LIMIT
+from forwarder.utils.metrics import REGISTRY, Counter
+
+# (账号, file_unique_id)，file_id 只对上传它的账号有效
+FileKey = Tuple[str, str]
+File = Union[str, "SpooledUpload"]
+
+# 媒体类型 -> (发送方法, 从原媒体复制的参数)
+_SEND_METHODS = {
+    "photo": ("send_photo", ()),
+    "video": ("send_video", ("duration", "width", "height", "file_name")),
+    "animation": ("send_animation", ("duration", "width", "height", "file_name")),
+    "document": ("send_document", ("file_name",)),
+    "audio": ("send_audio", ("duration", "performer", "title", "file_name")),
+    "voice": ("send_voice", ("duration",)),
+    "video_note": ("send_video_note", ("duration", "length")),
+    "sticker": ("send_sticker", ()),
+}
+_INPUT_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "animation": InputMediaAnimation,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+_DEFAULT_NAMES = {"photo": "photo.jpg", "sticker": "sticker.webp", "voice": "voice.ogg"}
+
+MEDIA_UPLOADS = REGISTRY.register(
+    Counter("forwarder_media_uploads_total", "Media downloaded and uploaded again", ["kind"])
+)
+MEDIA_REUSED = REGISTRY.register(
+    Counter(
+        "forwarder_media_reused_total", "Re-sent media that reused an earlier upload", ["kind"]
+    )
+)
+
+
+class SpooledUpload(io.RawIOBase):
+    """A downloaded file, kept in memory up to TRANSFER_MEMORY_LIMIT bytes and on disk
+    beyond, with the `name` pyrogram gives the upload"""
+
+    def __init__(self, name: str):
+        super().__init__()
+        self.name = name
+        self._spool = SpooledTemporaryFile(max_size=TRANSFER_MEMORY_LIMIT)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._spool.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._spool.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._spool.tell()
+
+    def write_chunk(self, chunk: bytes):
+        self._spool.write(chunk)
+
+    def close(self):
+        self._spool.close()
+        super().close()
+
+
+class FileIdCache:
+    """The file_id of media an account already uploaded, least recently used dropped first"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self._entries: "OrderedDict[FileKey, str]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: FileKey) -> Optional[str]:
+        file_id = self._entries.get(key)
+        if file_id is not None:
+            self._entries.move_to_end(key)
+        return file_id
+
+    def put(self, key: FileKey, file_id: str):
+        self._entries[key] = file_id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, key: FileKey):
+        self._entries.pop(key, None)
+
+
+def _media_kind(message: Message) -> Optional[str]:
+    kind = message.media.value if message.media else None
+    return kind if kind in _SEND_METHODS else None
+
+
+class Transfers:
+    """Re-send messages of sources that don't allow forwarding or copying.
+
+    The media is downloaded through a spooled temporary file and uploaded
+    again. The file_id of the upload is cached per account, so the same media
+    goes to the other destinations without another transfer; a destination
+    that needs media which is being uploaded right now waits for that upload.
+    At most TRANSFER_CONCURRENCY transfers run at once, the scheduler leaves
+    other destinations' sends to the free workers meanwhile.
+    """
+
+    def __init__(self, concurrency: int, cache_size: int):
+        self.protected: Set[int] = set()
+        self.cache = FileIdCache(cache_size)
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        # 正在上传的文件，完成后缓存里就有 file_id
+        self._uploads: Dict[FileKey, asyncio.Future] = {}
+
+    @property
+    def busy(self) -> bool:
+        """Whether a new transfer would have to wait"""
+        return self._semaphore.locked()
+
+    def protect(self, source: int):
+        if source not in self.protected:
+            self.protected.add(source)
+            LOGGER.info(f"Source {source} restricts forwarding, re-uploading its messages")
+
+    async def send(
+        self,
+        client: Client,
+        source: int,
+        message_ids: Sequence[int],
+        chat_id: int,
+        thread_id: Optional[int] = None,
+        album: bool = False,
+    ) -> Union[Message, List[Message], None]:
+        """Send messages of a protected source as new messages, in order"""
+        messages = await client.get_messages(source, list(message_ids))
+        messages = [message for message in messages if not message.empty]
+        if album and len(messages) > 1:
+            return await self._send_album(client, messages, chat_id, thread_id)
+        sent = None
+        for message in messages:
+            sent = await self._send_single(client, message, chat_id, thread_id)
+        return sent
+
+    async def _send_single(
+        self, client: Client, message: Message, chat_id: int, thread_id: Optional[int]
+    ) -> Optional[Message]:
+        kind = _media_kind(message)
+        if kind is None:
+            if not message.text:
+                LOGGER.warning("Can't re-send message %s, unsupported content", message.id)
+                return None
+            return await client.send_message(
+                chat_id, message.text, entities=message.entities, reply_to_message_id=thread_id
+            )
+
+        method, fields = _SEND_METHODS[kind]
+        media = getattr(message, kind)
+        extra = {field: getattr(media, field, None) for field in fields}
+        if kind not in ("video_note", "sticker"):
+            extra.update(caption=message.caption or "", caption_entities=message.caption_entities)
+
+        async def send(files: List[File]) -> List[Message]:
+            result = await getattr(client, method)(
+                chat_id, files[0], reply_to_message_id=thread_id, **extra
+            )
+            return [result]
+
+        sent = await self._upload_once(client, [message], send)
+        return sent[0]
+
+    async def _send_album(
+        self, client: Client, messages: List[Message], chat_id: int, thread_id: Optional[int]
+    ) -> List[Message]:
+        items = [m for m in messages if _media_kind(m) in _INPUT_MEDIA]
+        if len(items) < 2:
+            # 相册至少两项，其余只能逐条发送
+            return [await self._send_single(client, m, chat_id, thread_id) for m in messages]
+
+        async def send(files: List[File]) -> List[Message]:
+            media = [
+                _INPUT_MEDIA[_media_kind(message)](
+                    file, caption=message.caption or "", caption_entities=message.caption_entities
+                )
+                for message, file in zip(items, files)
+            ]
+            return await client.send_media_group(chat_id, media, reply_to_message_id=thread_id)
+
+        return await self._upload_once(client, items, send)
+
+    async def _upload_once(
+        self,
+        client: Client,
+        messages: List[Message],
+        send: Callable[[List[File]], Awaitable[List[Message]]],
+    ) -> List[Message]:
+        """Call `send` with the cached file_id of each message's media, or with the
+        downloaded file for those not uploaded yet, and cache the new file_ids"""
+        kinds = [_media_kind(message) for message in messages]
+        keys = [
+            (client.name, getattr(message, kind).file_unique_id)
+            for message, kind in zip(messages, kinds)
+        ]
+
+        # 其他目标正在上传同一文件时等它完成
+        while True:
+            pending = {self._uploads[key] for key in keys if key in self._uploads}
+            if not pending:
+                break
+            await asyncio.wait(pending)
+
+        files: List[Optional[File]] = [self.cache.get(key) for key in keys]
+        if all(files):
+            try:
+                sent = await send(files)
+            except BadRequest as err:
+                # file_id 失效时重新上传
+                LOGGER.warning("Cached media was rejected (%s), uploading it again", err)
+                for key in keys:
+                    self.cache.discard(key)
+                files = [None] * len(keys)
+            else:
+                for kind in kinds:
+                    MEDIA_REUSED.inc(kind)
+                return sent
+
+        missing = [key for key, file in zip(keys, files) if file is None]
+        done = asyncio.get_running_loop().create_future()
+        for key in missing:
+            self._uploads[key] = done
+        try:
+            async with self._semaphore:
+                for index, file in enumerate(files):
+                    if file is None:
+                        files[index] = await self._download(client, messages[index], kinds[index])
+                        MEDIA_UPLOADS.inc(kinds[index])
+                try:
+                    sent = await send(files)
+                except BadRequest:
+                    for key in keys:
+                        self.cache.discard(key)
+                    raise
+                finally:
+                    for file in files:
+                        if isinstance(file, SpooledUpload):
+                            file.close()
+        finally:
+            for key in missing:
+                del self._uploads[key]
+            done.set_result(None)
+
+        for key, kind, message in zip(keys, kinds, sent):
+            media = getattr(message, kind, None)
+            if media is not None:
+                self.cache.put(key, media.file_id)
+        return sent
+
+    async def _download(self, client: Client, message: Message, kind: str) -> SpooledUpload:
+        media = getattr(message, kind)
+        name = getattr(media, "file_name", None) or _DEFAULT_NAMES.get(kind, kind)
+        upload = SpooledUpload(name)
+        try:
+            async for chunk in client.stream_media(message):
+                upload.write_chunk(chunk)
+        except BaseException:
+            upload.close()
+            raise
+        upload.seek(0)
+        return upload
+
+
+transfers = Transfers(TRANSFER_CONCURRENCY, TRANSFER_CACHE_SIZE)
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import time
+from typing import Dict, Optional
+
+from forwarder import (
+    LOGGER,
+    WATCHDOG_BACKLOG_LIMIT,
+    WATCHDOG_LAG_LIMIT,
+    WATCHDOG_RESTART,
+    WATCHDOG_SILENCE_LIMIT,
+    app,
+)
+from forwarder.utils.httpd import Response, http_server
+from forwarder.utils.lifecycle import on_shutdown, on_startup, restart_client
+from forwarder.utils.metrics import REGISTRY, Gauge
+from forwarder.utils.sender import scheduler
+
+# 测量事件循环延迟的间隔 (秒)
+SAMPLE_INTERVAL = 1
+
+
+class Watchdog:
+    """Notice a stuck forwarder from inside the process.
+
+    A sampler task measures how late the event loop wakes it up, which shows
+    blocking handlers and CPU starvation. Every update from Telegram and every
+    message of a source is timestamped, so a dead update stream shows as
+    silence. Together with the send backlog this backs /healthz (the process
+    works) and /readyz (it forwards). When WATCHDOG_RESTART is set, the client
+    reconnects after WATCHDOG_SILENCE_LIMIT seconds without updates.
+    """
+
+    def __init__(self):
+        now = time.monotonic()
+        self.lag = 0.0
+        self.sampled = now
+        self.updated = now
+        self.restarts = 0
+        self.sources: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def seen(self, chat_id: int):
+        """Record a message from a source chat"""
+        now = time.monotonic()
+        self.updated = now
+        self.sources[chat_id] = now
+
+    def silence(self) -> float:
+        """Seconds since the last update of any kind"""
+        return time.monotonic() - self.updated
+
+    def healthy(self) -> bool:
+        # 采样任务自己也可能被卡住
+        stalled = time.monotonic() - self.sampled > SAMPLE_INTERVAL + WATCHDOG_LAG_LIMIT
+        return self.lag <= WATCHDOG_LAG_LIMIT and not stalled
+
+    def problems(self) -> list:
+        """Reasons the forwarder is not ready, empty when it is"""
+        problems = []
+        if not self.healthy():
+            problems.append(f"event loop lag {self.lag:.1f}s")
+        if not app.is_connected:
+            problems.append("client disconnected")
+        if WATCHDOG_SILENCE_LIMIT and self.silence() > WATCHDOG_SILENCE_LIMIT:
+            problems.append(f"no updates for {self.silence():.0f}s")
+        if WATCHDOG_BACKLOG_LIMIT and scheduler.pending() > WATCHDOG_BACKLOG_LIMIT:
+            problems.append(f"{scheduler.pending()} messages waiting to be sent")
+        return problems
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        return {
+            "event_loop_lag": round(self.lag, 3),
+            "seconds_since_update": round(now - self.updated, 1),
+            "seconds_since_source_update": {
+                str(chat): round(now - seen, 1) for chat, seen in self.sources.items()
+            },
+            "pending_sends": scheduler.pending(),
+            "oldest_pending_send": round(scheduler.backlog_age(), 1),
+            "restarts": self.restarts,
+        }
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            self.lag = max(0.0, loop.time() - started - SAMPLE_INTERVAL)
+            self.sampled = time.monotonic()
+            if self.lag > WATCHDOG_LAG_LIMIT:
+                LOGGER.warning(f"Event loop was blocked for {self.lag:.1f} seconds")
+
+            silent = WATCHDOG_SILENCE_LIMIT and self.silence() > WATCHDOG_SILENCE_LIMIT
+            if silent and WATCHDOG_RESTART:
+                await self._restart()
+
+    async def _restart(self):
+        LOGGER.warning(f"No updates for {self.silence():.0f} seconds, reconnecting")
+        # 重连失败时也等下一个周期再试
+        self.updated = time.monotonic()
+        self.restarts += 1
+        try:
+            await restart_client()
+        except Exception as err:
+            LOGGER.error(f"Failed to reconnect the client: {err}")
+
+
+watchdog = Watchdog()
+
+REGISTRY.register(
+    Gauge("forwarder_event_loop_lag_seconds", "Last measured event loop lag", lambda: watchdog.lag)
+)
+REGISTRY.register(
+    Gauge("forwarder_update_silence_seconds", "Seconds since the last update", watchdog.silence)
+)
+REGISTRY.register(
+    Gauge(
+        "forwarder_backlog_age_seconds",
+        "Seconds the oldest waiting message has been queued",
+        scheduler.backlog_age,
+    )
+)
+REGISTRY.register(
+    Gauge(
+        "forwarder_client_restarts",
+        "Reconnects after a silent update stream",
+        lambda: watchdog.restarts,
+    )
+)
+
+
+@app.on_raw_update(group=-1)
+async def record_update(client, update, users, chats):
+    watchdog.updated = time.monotonic()
+
+
+def _json(status: int, data: dict) -> Response:
+    return status, "application/json", json.dumps(data, ensure_ascii=False) + "\n"
+
+
+@http_server.route("/healthz")
+async def healthz():
+    healthy = watchdog.healthy()
+    return _json(200 if healthy else 503, {"ok": healthy, **watchdog.status()})
+
+
+@http_server.route("/readyz")
+async def readyz():
+    problems = watchdog.problems()
+    data = {"ok": not problems, "problems": problems, **watchdog.status()}
+    return _json(503 if problems else 200, data)
+
+
+@on_startup
+async def start_watchdog():
+    watchdog.start()
+
+
+@on_shutdown
+async def stop_watchdog():
+    await watchdog.stop()
@@ -0,0 +1,52 @@
+import asyncio
+import json
+from typing import Optional, Tuple
+
+from forwarder import CONFIG, CONFIG_WATCH_INTERVAL, LOGGER, config_name
+from forwarder.utils.chat import apply_config
+from forwarder.utils.lifecycle import on_startup
+from forwarder.utils.store import config_store, file_signature
+
+
+def check_config_file():
+    """Load chat_list.json and swap the rules in if it was changed and is valid"""
+    try:
+        with open(config_name, "r") as data:
+            raw = json.load(data)
+    except (OSError, ValueError) as err:
+        LOGGER.error(f"Ignoring unreadable {config_name}: {err}")
+        return
+
+    # 内容和正在使用的规则相同，例如只是被重新保存
+    if raw == CONFIG:
+        return
+
+    try:
+        rules = apply_config(raw)
+    except ValueError as err:
+        LOGGER.error(f"Ignoring invalid {config_name}, keeping the current rules: {err}")
+        return
+    LOGGER.info(f"Reloaded {len(rules)} rules from {config_name}")
+
+
+async def watch_config(last: Optional[Tuple[int, int]]):
+    """轮询 chat_list.json 的修改时间，有变化时热加载"""
+    while True:
+        await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+        current = file_signature(config_name)
+        if current is None or current == last:
+            continue
+        # 命令的修改还没写入时文件里是旧规则，加载会覆盖掉这些修改，写入后再检查
+        if config_store.pending:
+            continue
+        last = current
+        if current == config_store.signature:
+            continue
+        check_config_file()
+
+
+if CONFIG_WATCH_INTERVAL > 0:
+
+    @on_startup
+    async def start_config_watcher():
+        asyncio.create_task(watch_config(file_signature(config_name)))